@@ -0,0 +1,236 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import pretty_midi
+
+import matplotlib
+matplotlib.use("Agg")
+
+import correction
+import overlap
+import toaudio
+from notetable import NoteTable
+
+DEFAULT_SIZES = [1, 2, 5, 10]   # minutes of synthetic music
+DEFAULT_REPEAT = 3              # best-of-N timing
+REGRESSION_TOL = 0.25           # slower than baseline by more than this fraction = regression
+MIN_DELTA_S = 0.005             # ... and by more than this many seconds (timer noise on tiny paths)
+ACCURACY_TOL_MS = 5.0           # median warp error worse than baseline by more than this = regression
+
+
+# ========== synthetic data ==========
+class SyntheticWarp:
+    """Known GT -> Transkun time map: t' = offset + rate * t + drift * sin(2 pi t / period)."""
+
+    def __init__(self, offset=1.3, rate=1.01, drift=0.5, period=300.0):
+        self.offset, self.rate, self.drift, self.period = offset, rate, drift, period
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=np.float64)
+        return self.offset + self.rate * t + self.drift * np.sin(2 * np.pi * t / self.period)
+
+def synth_pair(minutes, seed=0, polyphony=3, warp=None, drop=0.05, extra=0.1, pitch_err=0.03,
+               jitter=0.002):
+    """
+    A GT MIDI of `minutes` random chords and its simulated transcription:
+      polyphony    : max notes per chord (1..polyphony)
+      warp         : SyntheticWarp applied to every time (tempo drift)
+      drop         : fraction of GT notes missing from the transcription
+      extra        : spurious notes added per chord (probability)
+      pitch_err    : fraction of transcribed notes off by a semitone
+      jitter       : std (s) of transcribed onset noise, one draw per chord
+    Onsets are quantised to the MIDI tick grid, so every chord keeps a single onset through
+    the write/read round trip in both files.
+    Returns (gt PrettyMIDI, transkun PrettyMIDI, warp).
+    """
+    rng = np.random.default_rng(seed)
+    warp = warp or SyntheticWarp()
+    gt, tr = pretty_midi.PrettyMIDI(), pretty_midi.PrettyMIDI()
+    tick = gt.tick_to_time(1)
+
+    def quantise(x):
+        return round(float(x) / tick) * tick
+
+    gi, ti = pretty_midi.Instrument(0), pretty_midi.Instrument(0)
+    t, total = 0.5, minutes * 60.0
+    while t < total:
+        dur = rng.uniform(0.1, 0.8)
+        st, ts = quantise(t), quantise(warp(t) + rng.normal(0, jitter))
+        for p in rng.choice(np.arange(40, 90), size=rng.integers(1, polyphony + 1), replace=False):
+            gi.notes.append(pretty_midi.Note(80, int(p), st, st + dur))
+            # keep the final chord intact so the last anchor is always findable
+            last = t + 1 > total
+            if rng.random() >= drop or last:
+                wrong = rng.random() < pitch_err and not last
+                ti.notes.append(pretty_midi.Note(70, int(p) + wrong, ts, float(warp(t + dur))))
+        if rng.random() < extra:
+            te = quantise(warp(t) + rng.uniform(0, 0.2))
+            ti.notes.append(pretty_midi.Note(30, int(rng.integers(30, 95)), te, te + 0.1))
+        t += rng.choice([0.125, 0.25, 0.25, 0.5, 0.04, 0.02])
+    gt.instruments.append(gi)
+    tr.instruments.append(ti)
+    return gt, tr, warp
+
+
+# ========== timing ==========
+def best_of(fn, repeat):
+    """Minimum wall time of `repeat` calls (and the last return value)."""
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+def warp_error_ms(result, gt_notes, true_warp):
+    """|recovered - true| Transkun time of every GT onset, in ms: (median, p95, max)."""
+    err = np.abs(result.warp.apply_times(gt_notes.start) - true_warp(gt_notes.start)) * 1000
+    return float(np.median(err)), float(np.percentile(err, 95)), float(err.max())
+
+def bench_size(minutes, seed, repeat, workdir, audio=True):
+    """Time every hot path on one synthetic pair; returns {name: seconds} plus accuracy figures."""
+    gt, tr, true_warp = synth_pair(minutes, seed=seed)
+    gt_path, tr_path = workdir / f"gt_{minutes}.mid", workdir / f"tr_{minutes}.mid"
+    out_path = workdir / f"aligned_{minutes}.mid"
+    gt.write(str(gt_path))
+    tr.write(str(tr_path))
+    quiet = logging.getLogger("bench.quiet")
+    quiet.addHandler(logging.NullHandler())
+    quiet.propagate = False
+    times = {}
+
+    times["align_gt_to_transkun"], result = best_of(
+        lambda: correction.align_gt_to_transkun(gt_path, tr_path, out_path, logger=quiet), repeat)
+
+    gt_notes, tr_notes = correction.as_notes(gt_path), correction.as_notes(tr_path)
+    times["onset_index"], (gt_index, tr_index) = best_of(
+        lambda: (correction.OnsetIndex(gt_notes, 0.01), correction.OnsetIndex(tr_notes, 0.01)), repeat)
+    times["find_first_anchor"], first = best_of(
+        lambda: correction.find_first_anchor_original(gt_index, tr_index, correction.n_attempts, logger=quiet), repeat)
+    times["find_last_anchor"], _ = best_of(
+        lambda: correction.find_last_anchor_original(gt_index, tr_index, first[2], logger=quiet), repeat)
+    mid = gt_index.onsets[-1] / 2
+    times["middle_anchor_window"], _ = best_of(
+        lambda: correction.find_segment_anchor_sequence_expected(
+            gt_index, tr_index, mid, float(true_warp(mid)), correction.max_back, correction.max_fwd,
+            None, logger=quiet), repeat)
+    times["middle_anchor_coarse"], _ = best_of(
+        lambda: correction.find_segment_anchor_coarse_to_fine(gt_index, tr_index, mid, None, logger=quiet), repeat)
+
+    by_pitch_a = NoteTable.from_midi(tr_path).by_pitch()
+    by_pitch_b = NoteTable.from_midi(out_path).by_pitch()
+    def intervals(by_pitch, p):
+        s, e = by_pitch.get(p, (np.empty(0), np.empty(0)))
+        return list(zip(s.tolist(), e.tolist()))
+    pairs = [(intervals(by_pitch_a, p), intervals(by_pitch_b, p)) for p in sorted(set(by_pitch_a) | set(by_pitch_b))]
+    times["split_segments"], _ = best_of(
+        lambda: [overlap.split_segments(a, b, "black", "skyblue", "red", 0.01) for a, b in pairs], repeat)
+    with contextlib.redirect_stdout(io.StringIO()):
+        times["plot_overlap"], _ = best_of(
+            lambda: overlap.plot_overlap(tr_path, out_path, workdir / "overlap.png", 0.0, None, 0.01, "time", 25), 1)
+        if audio and toaudio.fluidsynth is not None:
+            times["midi_to_audio"], _ = best_of(
+                lambda: toaudio.midi_to_audio(out_path, workdir / "aligned.wav"), 1)
+
+    median_ms, p95_ms, max_ms = warp_error_ms(result, NoteTable.from_midi(gt_path), true_warp)
+    return {"minutes": minutes, "notes": len(gt_notes), "times": times,
+            "accuracy": {"median_ms": median_ms, "p95_ms": p95_ms, "max_ms": max_ms}}
+
+
+# ========== reporting ==========
+def scaling_exponents(rows):
+    """Per benchmark, slope of log(time) over log(notes): ~1 linear, ~2 quadratic."""
+    out = {}
+    for name in bench_names(rows):
+        pts = [(r["notes"], r["times"][name]) for r in rows if name in r["times"] and r["times"][name] > 0]
+        if len(pts) >= 2:
+            x, y = np.log([p[0] for p in pts]), np.log([p[1] for p in pts])
+            out[name] = float(np.polyfit(x, y, 1)[0])
+    return out
+
+def bench_names(rows):
+    """Benchmark names in first-seen order (failed sizes have no times)."""
+    return list(dict.fromkeys(name for r in rows for name in r["times"]))
+
+def report(rows, exponents):
+    names = bench_names(rows)
+    header = f"{'benchmark':<24}" + "".join(f"{str(r['minutes']) + ' min':>11}" for r in rows) + f"{'scaling':>9}"
+    lines = [header, "-" * len(header)]
+    for name in names:
+        cells = "".join(f"{r['times'][name] * 1000:>9.1f}ms" if name in r["times"] else f"{'-':>11}" for r in rows)
+        exp = exponents.get(name)
+        lines.append(f"{name:<24}{cells}{'' if exp is None else f'n^{exp:.2f}':>9}")
+    for label, key in (("warp error (median)", "median_ms"), ("warp error (p95)", "p95_ms")):
+        lines.append(f"{label:<24}" + "".join(f"{'failed':>11}" if r.get("error") else f"{r['accuracy'][key]:>9.1f}ms"
+                                              for r in rows))
+    lines += [f"{r['minutes']} min failed: {r['error']}" for r in rows if r.get("error")]
+    return "\n".join(lines)
+
+def compare(rows, baseline, tolerance, accuracy_tol):
+    """Regressions against a stored run: list of human-readable lines (empty = none)."""
+    base = {r["minutes"]: r for r in baseline["rows"]}
+    problems = []
+    for r in rows:
+        b = base.get(r["minutes"])
+        if b is None:
+            continue
+        if r.get("error"):
+            if not b.get("error"):
+                problems.append(f"alignment @ {r['minutes']} min failed: {r['error']}")
+            continue
+        for name, t in r["times"].items():
+            bt = b["times"].get(name)
+            if bt and t > bt * (1 + tolerance) and t - bt > MIN_DELTA_S:
+                problems.append(f"{name} @ {r['minutes']} min: {t * 1000:.1f} ms vs baseline {bt * 1000:.1f} ms (+{(t / bt - 1):.0%})")
+        if b.get("error"):
+            continue
+        acc, bacc = r["accuracy"]["median_ms"], b["accuracy"]["median_ms"]
+        if acc > bacc + accuracy_tol:
+            problems.append(f"warp error @ {r['minutes']} min: median {acc:.1f} ms vs baseline {bacc:.1f} ms")
+    return problems
+
+def run(sizes, seed=0, repeat=DEFAULT_REPEAT, audio=True):
+    """bench_size for every size; a size whose alignment fails becomes a row with its "error"."""
+    logging.getLogger("correction").setLevel(logging.WARNING)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for m in sizes:
+            try:
+                rows.append(bench_size(m, seed, repeat, Path(tmp), audio=audio))
+            except RuntimeError as err:
+                rows.append({"minutes": m, "notes": None, "times": {}, "accuracy": None, "error": str(err)})
+    return {"meta": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                     "cpus": os.cpu_count(), "seed": seed, "repeat": repeat,
+                     "config": correction.config()},
+            "rows": rows, "scaling": scaling_exponents(rows)}
+
+# === CLI entry ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark alignment, overlap and rendering on synthetic GT/Transkun pairs with a known warp.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=DEFAULT_SIZES, help="Piece lengths in minutes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic pairs")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Best-of-N timing")
+    parser.add_argument("--no-audio", action="store_true", help="Skip midi_to_audio (also skipped without pyfluidsynth)")
+    parser.add_argument("--output", type=str, default=None, help="Write the full results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare against a stored results JSON; exit 1 on regressions")
+    parser.add_argument("--save-baseline", type=str, default=None, help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOL, help="Allowed slowdown fraction before flagging")
+    args = parser.parse_args()
+
+    results = run(args.sizes, seed=args.seed, repeat=args.repeat, audio=not args.no_audio)
+    print(report(results["rows"], results["scaling"]))
+    for path in filter(None, [args.output, args.save_baseline]):
+        Path(path).write_text(json.dumps(results, indent=1))
+        print(f"Results saved to: {path}")
+    if args.baseline:
+        problems = compare(results["rows"], json.loads(Path(args.baseline).read_text()), args.tolerance, ACCURACY_TOL_MS)
+        print("\nNo regressions against baseline." if not problems else "\nRegressions:\n  " + "\n  ".join(problems))
+        raise SystemExit(1 if problems else 0)
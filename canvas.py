@@ -1,90 +1,145 @@
+import argparse
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import pretty_midi
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from notetable import NoteTable
+from warp import load_warp
 
 
-# ========= File paths (edit these) =========
+# ========= File paths (defaults for the CLI) =========
 PRED_PATH = "/storage/user/ljia/folder_for_share/case6/transkun_output.mid"
 GT_PATH   = "/storage/user/ljia/folder_for_share/output.mid"
 
-# ========= Anchors & window (edit these) =========
-# Anchor times are in seconds on the (aligned) timeline.
-# Add as many as you like.
-anchor_times = [
-    13.405,
-120,240,
-    360.0,480,
-    600.0,720,
-    900.0,
-1500,
-]
+# ========= Window & figure =========
 window = 10.0  # seconds before/after each anchor
+FIGSIZE = (16, 8)
+DPI = 300
+PITCH_RANGE = (20, 100)  # adjust if your range is wider/narrower
 
 
 # ========= Helper functions =========
-def extract_notes(mid_path, time_range=None):
+def anchor_times_from(source):
     """
-    Extract (start, end, pitch) tuples from a MIDI file.
-    If `time_range=(t0, t1)` is provided, only notes whose *start* lies within [t0, t1] are returned.
+    Anchor times on the aligned (Transkun) timeline, from a warp sidecar path, an
+    AlignmentResult or a TimeWarp.
     """
-    midi = pretty_midi.PrettyMIDI(str(mid_path))
-    notes = []
-    for inst in midi.instruments:
-        if inst.is_drum:
-            continue  # skip drum tracks
-        for n in inst.notes:
-            if time_range is None:
-                notes.append((n.start, n.end, n.pitch))
-            else:
-                t0, t1 = time_range
-                if t0 <= n.start <= t1:
-                    notes.append((n.start, n.end, n.pitch))
-    return notes
-
-
-def plot_notes(notes, ax, title, color="black"):
+    return sorted(load_warp(source).anchors[:, 1].tolist())
+
+
+def note_segments(table):
+    """(N, 2, 2) line segments (start, pitch) -> (end, pitch) of a NoteTable."""
+    pitch = table.pitch.astype(np.float64)
+    return np.stack([np.column_stack([table.start, pitch]), np.column_stack([table.end, pitch])], axis=1)
+
+
+class WindowFigure:
+    """
+    One 2-row figure (GT on top, Transkun below) reused for every window: each render
+    only swaps the line segments, titles and x range before saving.
+    """
+
+    def __init__(self, figsize=FIGSIZE, dpi=DPI):
+        self.dpi = dpi
+        self.fig, self.axes = plt.subplots(2, 1, figsize=figsize, sharex=True)
+        self.lines = []
+        for ax, color in zip(self.axes, ("green", "red")):
+            lines = LineCollection([], colors=color, linewidths=2)
+            ax.add_collection(lines)
+            ax.set_xlabel("Time (s)")
+            ax.set_ylabel("MIDI pitch")
+            ax.set_ylim(*PITCH_RANGE)
+            ax.grid(True)
+            self.lines.append(lines)
+        self._laid_out = False
+
+    def render(self, gt, pred, t0, t1, output_path):
+        for ax, lines, label, table in zip(self.axes, self.lines, ("GT ", "Pred"), (gt, pred)):
+            lines.set_segments(note_segments(table))
+            ax.set_title(f"{label} ({t0:.3f}_{t1:.3f}s)")
+        self.axes[0].set_xlim(t0, t1)
+        if not self._laid_out:
+            # titles and tick labels keep their size from window to window
+            self.fig.tight_layout()
+            self._laid_out = True
+        self.fig.savefig(output_path, dpi=self.dpi)
+
+    def close(self):
+        plt.close(self.fig)
+
+
+# ========= Rendering =========
+def window_jobs(anchors, half_width, output_dir):
+    """(index, center, t0, t1, output path) per anchor, numbered from 1."""
+    output_dir = Path(output_dir)
+    return [(idx, c, c - half_width, c + half_width, output_dir / f"midi_compare_anchor_{idx}_{c:.3f}s.png")
+            for idx, c in enumerate(anchors, start=1)]
+
+
+def render_jobs(gt, pred, jobs, figsize=FIGSIZE, dpi=DPI):
+    """Render `jobs` (from window_jobs) with one figure; gt/pred are NoteTables or MIDI paths."""
+    gt = gt if isinstance(gt, NoteTable) else NoteTable.from_midi(gt, include_drums=False)
+    pred = pred if isinstance(pred, NoteTable) else NoteTable.from_midi(pred, include_drums=False)
+    figure = WindowFigure(figsize, dpi)
+    saved = []
+    try:
+        for _, _, t0, t1, output_path in jobs:
+            figure.render(gt.slice_time(t0, t1), pred.slice_time(t0, t1), t0, t1, output_path)
+            saved.append(str(output_path))
+    finally:
+        figure.close()
+    return saved
+
+
+def render_windows(gt_path, pred_path, anchors, half_width=window, output_dir=".", jobs=1, figsize=FIGSIZE, dpi=DPI):
     """
-    Plot notes as horizontal line segments on a simple piano-roll style axis.
-    Each line goes from note onset to offset at the note's pitch.
+    Save one GT-vs-Transkun piano-roll PNG per anchor time. Each file is loaded once
+    (per worker); with `jobs` > 1 the windows are dealt round-robin over a
+    process pool. Returns the saved paths in anchor order.
     """
-    for start, end, pitch in notes:
-        ax.plot([start, end], [pitch, pitch], color=color, linewidth=2)
-    ax.set_title(title)
-    ax.set_xlabel("Time (s)")
-    ax.set_ylabel("MIDI pitch")
-    ax.set_ylim(20, 100)  # adjust if your range is wider/narrower
-    ax.grid(True)
+    for label, path in (("GT", gt_path), ("Pred", pred_path)):
+        if not Path(path).exists():
+            raise FileNotFoundError(f"{label} MIDI not found: {path}")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    todo = window_jobs(anchors, half_width, output_dir)
+    jobs = max(1, min(jobs, len(todo)))
+    if jobs == 1:
+        return render_jobs(gt_path, pred_path, todo, figsize, dpi)
+    chunks = [todo[i::jobs] for i in range(jobs)]
+    # spawn, like run_all: no forked copies of a half-initialised matplotlib state
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(render_jobs, str(gt_path), str(pred_path), chunk, figsize, dpi) for chunk in chunks]
+        for fut in futures:
+            fut.result()
+    return [str(j[4]) for j in todo]
 
 
 def main():
-    # Basic existence checks
-    if not Path(GT_PATH).exists():
-        raise FileNotFoundError(f"GT MIDI not found: {GT_PATH}")
-    if not Path(PRED_PATH).exists():
-        raise FileNotFoundError(f"Pred MIDI not found: {PRED_PATH}")
-
-    # Loop over anchors and generate one figure per anchor
-    for idx, center_time in enumerate(anchor_times, start=1):
-        t0 = center_time - window
-        t1 = center_time + window
-
-        # Extract notes in the time window for both files
-        gt_notes   = extract_notes(GT_PATH, (t0, t1))
-        pred_notes = extract_notes(PRED_PATH, (t0, t1))  # assuming timelines are aligned
-
-        # Create a 2-row figure (GT on top, Transkun below)
-        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(16, 8), sharex=True)
-        plot_notes(gt_notes,   ax1, f"GT  ({t0:.3f}_{t1:.3f}s)",   color="green")
-        plot_notes(pred_notes, ax2, f"Pred ({t0:.3f}_{t1:.3f}s)", color="red")
-        plt.tight_layout()
-
-        # Save with a descriptive filename
-        out_name = f"midi_compare_anchor_{idx}_{center_time:.3f}s.png"
-        plt.savefig(out_name, dpi=300)
-        plt.close(fig)
-        print(f"Saved: {out_name}")
+    parser = argparse.ArgumentParser(description="Plot GT vs Transkun piano rolls in a window around every alignment anchor.")
+    parser.add_argument("--gt", type=str, default=GT_PATH, help="Aligned GT MIDI")
+    parser.add_argument("--pred", type=str, default=PRED_PATH, help="Transkun MIDI")
+    parser.add_argument("--warp", type=str, default=None, help="Warp sidecar whose anchors to plot (default: <gt stem>.warp.json next to --gt)")
+    parser.add_argument("--anchors", type=float, nargs="+", default=None, help="Explicit anchor times (s) instead of a warp sidecar")
+    parser.add_argument("--window", type=float, default=window, help="Seconds before/after each anchor (default: 10)")
+    parser.add_argument("--output-dir", type=str, default=".", help="Folder for the PNGs")
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes, 0 = all cores (default: 1)")
+    parser.add_argument("--dpi", type=int, default=DPI, help="PNG resolution (default: 300)")
+    args = parser.parse_args()
+
+    if args.anchors is not None:
+        anchors = sorted(args.anchors)
+    else:
+        warp_path = Path(args.warp) if args.warp else Path(args.gt).with_suffix(".warp.json")
+        if not warp_path.exists():
+            parser.error(f"no anchors: warp sidecar {warp_path} not found (give --warp or --anchors)")
+        anchors = anchor_times_from(warp_path)
+    for path in render_windows(args.gt, args.pred, anchors, args.window, args.output_dir,
+                               jobs=args.jobs if args.jobs > 0 else os.cpu_count() or 1, dpi=args.dpi):
+        print(f"Saved: {path}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,34 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# ========== note keys ==========
+PITCH_STRIDE = 1e6   # seconds; pitch-major keys (pitch * PITCH_STRIDE + time) keep every pitch's times in their own range
+
+
+# ========== case folders ==========
+def find_cases(root, paths):
+    """Folders under `root` (itself included) holding every relative path in `paths`, sorted."""
+    first = Path(paths[0])
+    dirs = sorted({p.parents[len(first.parts) - 1] for p in Path(root).rglob(str(first))})
+    return [d for d in dirs if all((d / path).exists() for path in paths)]
+
+def map_cases(fn, cases, *args, jobs=1):
+    """
+    fn(case, *args) for every case folder, over `jobs` spawn processes (in-process for 1).
+    Returns [(case, result or the exception it raised)], in the order of `cases`.
+    """
+    results = []
+    if jobs <= 1:
+        for d in cases:
+            try:
+                results.append((d, fn(d, *args)))
+            except Exception as err:
+                results.append((d, err))
+        return results
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [(d, pool.submit(fn, d, *args)) for d in cases]
+        for d, fut in futures:
+            err = fut.exception()
+            results.append((d, err if err is not None else fut.result()))
+    return results
@@ -1,7 +1,24 @@
 import argparse
+import logging
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
 from pathlib import Path
+import numpy as np
 import pretty_midi
 
+from common import PITCH_STRIDE
+from notetable import NoteTable, load_notes
+from warp import TimeWarp
+
+log = logging.getLogger("correction")
+_silent = logging.getLogger("correction.silent")   # for internal recomputations that would repeat log lines
+_silent.addHandler(logging.NullHandler())
+_silent.propagate = False
+
 # ==== Config ====
 segment_minutes = 2
 n_attempts = 5
@@ -33,49 +50,220 @@ extra_print_after = 5
 # max sliding for GT/Trans sequences (prefix groups to allow skipping)
 max_skip_prefix = 2
 
+# Transkun candidates scored per array operation (batched sequence matcher, first/last anchor scans)
+match_batch = 512
+
+# worker processes for the speculative middle-anchor search (1 = strictly sequential); the
+# result is identical either way, so this is not part of config()
+anchor_jobs = 1
+
+# middle-anchor search: "window" = expected-offset window, coarse-to-fine if it misses;
+# "coarse" = coarse-to-fine only (for heavily drifted recordings)
+anchor_search     = "window"
+coarse_hop        = 0.5    # seconds per pitch-histogram frame
+coarse_span       = 8.0    # seconds of GT per coarse signature
+coarse_candidates = 5      # best coarse positions refined with the exact sequence matcher
+coarse_refine     = 1.0    # +/- seconds searched exactly around each coarse position (plus the GT groups' lead)
+coarse_distance_penalty = 0.05   # cosine score deducted per minute between a coarse position and the expected one
+
+# segmentation: "fixed" = segment_minutes everywhere; "adaptive" = start with adaptive_minutes
+# segments and halve a segment while its onset residual exceeds residual_tol
+segment_mode        = "fixed"
+adaptive_minutes    = 8
+min_segment_seconds = 30     # never split below this length
+residual_tol        = 0.03   # seconds, median |mapped GT onset - nearest same-pitch Transkun onset|
+residual_match      = 0.5    # seconds, farther onsets count as unmatched
+
+# note-level refinement: banded DP match of GT and Transkun onset groups around the segment
+# mappings, which are then replaced by a monotone warp through the matched onsets
+note_refine         = False
+refine_band         = 1.0    # seconds around each mapped GT onset searched for its Transkun group
+refine_max_band     = 64     # at most this many Transkun groups per GT group (band width)
+refine_min_ratio    = 0.5    # group match ratio needed to pair two groups
+refine_outlier      = 0.05   # seconds; pairs whose shift from the prior differs more from the median
+                             # shift of their OUTLIER_PAIRS neighbours are dropped
+refine_knot_spacing = 0.5    # min seconds of GT between warp knots (averages out onset jitter)
+refine_max_slope    = 2.0    # knots whose local slope leaves [1/x, x] are dropped
+
+CONFIG_NAMES = (
+    "segment_minutes", "n_attempts", "THRESH_FIRST", "THRESH_MIDDLE", "THRESH_LAST",
+    "seq_len", "seq_max_span", "safety_forward", "min_denom",
+    "scale_back", "scale_fwd", "min_back", "max_back", "min_fwd", "max_fwd",
+    "max_skip_prefix", "anchor_search", "coarse_hop", "coarse_span", "coarse_candidates", "coarse_refine",
+    "coarse_distance_penalty",
+    "segment_mode", "adaptive_minutes", "min_segment_seconds", "residual_tol", "residual_match",
+    "note_refine", "refine_band", "refine_max_band", "refine_min_ratio", "refine_outlier", "refine_knot_spacing", "refine_max_slope",
+)
+
+def config():
+    """Current values of the tuning constants that affect the alignment result."""
+    return {name: globals()[name] for name in CONFIG_NAMES}
+
 # ========== helpers ==========
 def extract_notes(midi_path):
-    """Return (notes, midi) where notes are (start, end, pitch) for non-drum."""
-    midi = pretty_midi.PrettyMIDI(str(midi_path))
-    notes = []
-    for inst in midi.instruments:
-        if inst.is_drum:
-            continue
-        for n in inst.notes:
-            notes.append((n.start, n.end, n.pitch))
-    return notes, midi
+    """Return (notes, midi) where notes is the onset-sorted NoteTable of the non-drum tracks."""
+    midi = midi_path if isinstance(midi_path, pretty_midi.PrettyMIDI) else pretty_midi.PrettyMIDI(str(midi_path))
+    return NoteTable.from_midi(midi, include_drums=False), midi
 
-def group_at_time(notes, t, epsilon):
-    """All pitches whose onset is within epsilon of time t."""
-    return [p for s, e, p in notes if abs(s - t) < epsilon]
+def as_notes(source):
+    """
+    Non-drum NoteTable from a MIDI path, a PrettyMIDI object, a NoteTable, or an
+    already-parsed sequence / (N, 3) array of (start, end, pitch) rows.
+    """
+    return load_notes(source, include_drums=False)
 
-def collect_gt_groups_from_time(gt_notes, start_time, epsilon, max_groups):
+class OnsetIndex:
+    """
+    Onset index over a NoteTable (or anything load_notes accepts), built once per MIDI file.
+    `group_at(t)` returns the same pitches as a linear scan for |start - t| < epsilon,
+    in original note order, but with two bisections instead of a pass over all notes.
+    `extend` appends notes of a growing transcription, rebuilding only the affected tail.
+    """
+    def __init__(self, notes, epsilon):
+        notes = load_notes(notes)
+        self.epsilon = epsilon
+        self.starts  = notes.start.tolist()       # onset-sorted
+        self.pitches = notes.pitch.tolist()
+        self.rank    = notes.order.tolist()       # original note position
+        self.onsets  = np.unique(notes.start).tolist()   # distinct onset times
+        self._groups = {}          # group_at cache for t < _settled
+        self._recent = {}          # ... and for later t, which extend() may invalidate
+        self._settled = float("-inf")
+        self._onset_array = None
+        self._masks = None
+        self._hists = {}
+
+    def extend(self, notes):
+        """
+        Add notes (e.g. the next chunk of a growing transcription; rank continues after the
+        current notes). The result equals an index over the concatenated tables, but only
+        the part from the earliest new onset on is rebuilt: sorted columns and distinct
+        onsets are merged, groups and masks within 2 * epsilon before it recomputed, and
+        histograms incremented.
+        """
+        notes = load_notes(notes)
+        if not len(notes):
+            return self
+        eps, first = self.epsilon, float(notes.start[0])
+        # notes from `first` on interleave with the new ones; equal onsets keep old notes first
+        p = bisect_left(self.starts, first)
+        starts = np.concatenate([self.starts[p:], notes.start])
+        idx = np.argsort(starts, kind="stable")
+        pitches = np.concatenate([np.asarray(self.pitches[p:], dtype=np.int64), notes.pitch])[idx]
+        rank = np.concatenate([np.asarray(self.rank[p:], dtype=np.int64), notes.order + len(self.starts)])[idx]
+        self.starts[p:] = starts[idx].tolist()
+        self.pitches[p:] = pitches.tolist()
+        self.rank[p:] = rank.tolist()
+        k = bisect_left(self.onsets, first)
+        self.onsets[k:] = np.unique(starts).tolist()
+        self._onset_array = None
+
+        # group_at(t) reads onsets up to t + 2 * eps
+        cut = first - 2 * eps
+        if cut < self._settled:   # reaches before the previous cut: re-check the settled groups too
+            self._recent.update(self._groups)
+            self._groups = {}
+        self._groups.update((t, g) for t, g in self._recent.items() if t < cut)
+        self._recent, self._settled = {}, cut
+        if self._masks is not None:
+            km = bisect_left(self.onsets, cut)
+            head, tail = self._masks[:km], self._group_masks(self.onsets[km:])
+            layers = max(head.shape[1], tail.shape[1])
+            self._masks = np.concatenate([np.pad(m, ((0, 0), (0, layers - m.shape[1]), (0, 0))) for m in (head, tail)])
+        for hop, hist in self._hists.items():
+            frames = (notes.start / hop).astype(np.int64)
+            n_frames = max(len(hist), int(frames.max()) + 1)
+            if n_frames > len(hist):
+                hist = self._hists[hop] = np.concatenate([hist, np.zeros((n_frames - len(hist), 128))])
+            np.add.at(hist, (frames, notes.pitch.astype(np.int64)), 1.0)
+        return self
+
+    def __len__(self):
+        return len(self.starts)
+
+    def group_at(self, t):
+        """All pitches whose onset is within epsilon of time t."""
+        cache = self._groups if t < self._settled else self._recent
+        g = cache.get(t)
+        if g is None:
+            eps = self.epsilon
+            # widened bisection bounds, then the exact predicate decides membership
+            lo = bisect_left(self.starts, t - 2 * eps)
+            hi = bisect_right(self.starts, t + 2 * eps)
+            hits = [i for i in range(lo, hi) if abs(self.starts[i] - t) < eps]
+            hits.sort(key=self.rank.__getitem__)
+            g = cache[t] = [self.pitches[i] for i in hits]
+        return g
+
+    @property
+    def onset_array(self):
+        """Distinct onset times as a float64 array."""
+        if self._onset_array is None:
+            self._onset_array = np.asarray(self.onsets, dtype=np.float64)
+        return self._onset_array
+
+    def onset_histogram(self, hop):
+        """Onset counts per (time frame of `hop` seconds, pitch): shape (n_frames, 128), cached per hop."""
+        hist = self._hists.get(hop)
+        if hist is None:
+            frames = (np.asarray(self.starts) / hop).astype(np.int64)
+            n_frames = int(frames.max()) + 1 if len(frames) else 0
+            flat = np.bincount(frames * 128 + np.asarray(self.pitches, dtype=np.int64), minlength=n_frames * 128)
+            hist = self._hists[hop] = flat.reshape(n_frames, 128).astype(np.float64)
+        return hist
+
+    def pitch_masks(self):
+        """
+        Group at every distinct onset as 128-bit pitch masks (two uint64 words),
+        shape (n_onsets, layers, 2). Layer l holds the pitches that occur more than
+        l times in the group, so repeated pitches keep their weight in |GT|.
+        """
+        if self._masks is None:
+            self._masks = self._group_masks(self.onsets)
+        return self._masks
+
+    def _group_masks(self, onsets):
+        """pitch_masks rows for the groups at `onsets`."""
+        rows, layers, pitches = [], [], []
+        for k, t in enumerate(onsets):
+            count = {}
+            for p in self.group_at(t):
+                rows.append(k)
+                layers.append(count.get(p, 0))
+                pitches.append(p)
+                count[p] = layers[-1] + 1
+        masks = np.zeros((len(onsets), max(layers, default=0) + 1, 2), dtype=np.uint64)
+        pitches = np.asarray(pitches, dtype=np.uint64)
+        np.bitwise_or.at(masks, (rows, layers, (pitches >> np.uint64(6)).astype(np.intp)),
+                         np.uint64(1) << (pitches & np.uint64(63)))
+        return masks
+
+def collect_gt_groups_from_time(gt_index, start_time, max_groups):
     """
     Collect up to `max_groups` GT pitch groups starting at or after `start_time`.
     A group is defined by the set of pitches at a distinct onset time.
     """
-    groups, seen = [], set()
-    for s, e, p in sorted(gt_notes, key=lambda x: x[0]):
-        t = s
-        if t < start_time - epsilon:
-            continue
-        if all(abs(t - st) >= epsilon for st in seen):
-            groups.append((t, group_at_time(gt_notes, t, epsilon)))
-            seen.add(t)
+    eps = gt_index.epsilon
+    onsets = gt_index.onsets
+    groups, last = [], None
+    for i in range(bisect_left(onsets, start_time - eps), len(onsets)):
+        t = onsets[i]
+        # onsets are sorted, so the nearest seen group time is the last one
+        if last is None or t - last >= eps:
+            groups.append((t, gt_index.group_at(t)))
+            last = t
         if len(groups) >= max_groups:
             break
     return groups
 
-def collect_group_sequence(notes, start_time, epsilon, max_groups, max_span):
+def collect_group_sequence(index, start_time, max_groups, max_span):
     """
     Build a forward sequence of up to `max_groups` groups starting from the first
     onset >= start_time - epsilon, stopping if time span exceeds `max_span`.
     Returns: list[(t, [pitches])]
     """
-    onset_times = sorted({s for s,_,_ in notes})
-    i = 0
-    while i < len(onset_times) and onset_times[i] < start_time - epsilon:
-        i += 1
+    onset_times = index.onsets
+    i = bisect_left(onset_times, start_time - index.epsilon)
     seq, first_t = [], None
     while i < len(onset_times) and len(seq) < max_groups:
         t = onset_times[i]
@@ -83,144 +271,228 @@ def collect_group_sequence(notes, start_time, epsilon, max_groups, max_span):
             first_t = t
         if (t - first_t) > max_span:
             break
-        g = group_at_time(notes, t, epsilon)
+        g = index.group_at(t)
         if g:
             seq.append((t, g))
         i += 1
     return seq
 
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount(x):
+    """Element-wise number of set bits of a uint64 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    x = np.ascontiguousarray(x)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+def pitch_mask(pitches):
+    """
+    A pitch group as a (layers, 2) uint64 mask, the layout of OnsetIndex.pitch_masks:
+    layer l holds the pitches that occur more than l times.
+    """
+    layers, count = [], {}
+    for p in pitches:
+        l = count.get(p, 0)
+        count[p] = l + 1
+        if l == len(layers):
+            layers.append([0, 0])
+        layers[l][p >> 6] |= 1 << (p & 63)
+    return np.array(layers or [[0, 0]], dtype=np.uint64)
+
+def as_mask(group):
+    return group if isinstance(group, np.ndarray) else pitch_mask(group)
+
 def group_match_ratio(gt_group, tr_group):
-    """|intersection| / |gt_group|; 0 if gt_group empty."""
-    if not gt_group:
+    """
+    |intersection| / |gt_group|; 0 if gt_group empty. Groups are pitch lists or masks:
+    repeated GT pitches count once per occurrence, TR pitches only need to be present.
+    """
+    gt, tr = as_mask(gt_group), as_mask(tr_group)
+    size = int(popcount(gt).sum())
+    if not size:
         return 0.0
-    inter = sum(1 for p in gt_group if p in tr_group)
-    return inter / len(gt_group)
+    return int(popcount(gt & tr[0]).sum()) / size
+
+def match_ratios(gt_mask, tr_masks):
+    """group_match_ratio of one GT mask against (n, 2) TR membership masks, as a float64 array."""
+    size = int(popcount(gt_mask).sum())
+    if not size:
+        return np.zeros(len(tr_masks))
+    return popcount(gt_mask[None, :, :] & tr_masks[:, None, :]).sum(axis=(1, 2)) / size
+
+def first_match(gt_mask, tr_masks, thresh, reverse=False):
+    """
+    First TR mask (last with `reverse`) whose match ratio reaches `thresh`, scanned in
+    blocks of `match_batch`. Returns (index or None, ratio, masks scanned like a scalar loop).
+    """
+    n = len(tr_masks)
+    for b in range(0, n, match_batch):
+        lo, hi = (max(0, n - b - match_batch), n - b) if reverse else (b, min(n, b + match_batch))
+        hit = np.flatnonzero(match_ratios(gt_mask, tr_masks[lo:hi]) >= thresh)
+        if len(hit):
+            k = lo + int(hit[-1] if reverse else hit[0])
+            return k, group_match_ratio(gt_mask, tr_masks[k][None]), n - k if reverse else k + 1
+    return None, 0.0, n
 
 def clamp(lo, x, hi):
     return max(lo, min(x, hi))
 
+def tally(counts, key, n=1):
+    """Add n to counts[key] when the caller asked for search statistics (counts is a dict)."""
+    if counts is not None and n:
+        counts[key] = counts.get(key, 0) + n
+
 # ========== your ORIGINAL first/last anchors ==========
-def find_first_anchor_original(gt_notes, transkun_notes, epsilon, n_attempts):
-    """Keep your original first-anchor search flow, threshold raised to 0.8."""
-    gt_time_pitch_groups, seen = [], set()
-    for note in sorted(gt_notes, key=lambda x: x[0]):
-        t = note[0]
-        if all(abs(t - st) >= epsilon for st in seen):
-            gt_time_pitch_groups.append((t, group_at_time(gt_notes, t, epsilon)))
-            seen.add(t)
-        if len(gt_time_pitch_groups) >= n_attempts:
-            break
+def find_first_anchor_original(gt_index, tr_index, n_attempts, logger=log, until=None, counts=None):
+    """
+    Keep your original first-anchor search flow, threshold raised to 0.8.
+    `until` limits the Transkun onsets considered (online mode: only the settled part).
+    """
+    gt_time_pitch_groups = collect_gt_groups_from_time(gt_index, float("-inf"), n_attempts)
+    tr_onsets = tr_index.onsets
+    n_tr = len(tr_onsets) if until is None else bisect_right(tr_onsets, until)
+    tr_masks = tr_index.pitch_masks()[:n_tr, 0, :]
 
-    trans_sorted = sorted(transkun_notes, key=lambda x: x[0])
     best = None
 
-    print("\n===== GT PITCH GROUPS (Top N) =====")
+    logger.info("\n===== GT PITCH GROUPS (Top N) =====")
     for i, (t_gt, gt_group) in enumerate(gt_time_pitch_groups):
-        print(f"Group {i+1}: Time = {t_gt:.3f}, GT Pitches = {sorted(gt_group)}")
-        matched = False
-        for s, e, p in trans_sorted:
-            t_trans = s
-            tr_group = group_at_time(transkun_notes, t_trans, epsilon)
-            if not gt_group:
-                continue
-            ratio = group_match_ratio(gt_group, tr_group)
-            if ratio >= THRESH_FIRST:
-                print(f"Matched in Transkun at {t_trans:.3f}, Pitches = {sorted(tr_group)}, Match Ratio = {ratio:.2f}")
-                matched = True
-                if best is None or t_trans < best[2]:
-                    best = (t_gt, gt_group, t_trans, i+1, ratio, tr_group)
-                break  # only first match for each group
-        if not matched:
-            print("No match found in Transkun.")
+        logger.info(f"Group {i+1}: Time = {t_gt:.3f}, GT Pitches = {sorted(gt_group)}")
+        k, ratio, scanned = first_match(gt_index.pitch_masks()[bisect_left(gt_index.onsets, t_gt)],
+                                        tr_masks, THRESH_FIRST)
+        tally(counts, "candidates", scanned)
+        if k is not None:
+            t_trans = tr_onsets[k]
+            tr_group = tr_index.group_at(t_trans)
+            logger.info(f"Matched in Transkun at {t_trans:.3f}, Pitches = {sorted(tr_group)}, Match Ratio = {ratio:.2f}")
+            if best is None or t_trans < best[2]:
+                best = (t_gt, gt_group, t_trans, i+1, ratio, tr_group)
+        else:
+            logger.info("No match found in Transkun.")
 
     if best is None:
         raise RuntimeError("Failed to find matching first anchor in Transkun MIDI.")
 
     t_gt, gt_p, t_tr, idx, r, tr_p = best
-    print("\n===== SELECTED FIRST ANCHOR =====")
-    print(f"Selected Group: #{idx}")
-    print(f"GT Time        : {t_gt:.3f}")
-    print(f"GT Pitches     : {sorted(gt_p)}")
-    print(f"Matched Time   : {t_tr:.3f} (in Transkun)")
-    print(f"Matched Pitches: {sorted(tr_p)}")
-    print(f"Match Ratio    : {r:.2f}")
+    logger.info("\n===== SELECTED FIRST ANCHOR =====")
+    logger.info(f"Selected Group: #{idx}")
+    logger.info(f"GT Time        : {t_gt:.3f}")
+    logger.info(f"GT Pitches     : {sorted(gt_p)}")
+    logger.info(f"Matched Time   : {t_tr:.3f} (in Transkun)")
+    logger.info(f"Matched Pitches: {sorted(tr_p)}")
+    logger.info(f"Match Ratio    : {r:.2f}")
     return best
 
-def find_last_anchor_original(gt_notes, transkun_notes, epsilon, first_aligned_time):
+def find_last_anchor_original(gt_index, tr_index, first_aligned_time, logger=log, counts=None):
     """Keep your original last-anchor search flow, threshold 0.8."""
-    last_gt_time = max(n[0] for n in gt_notes)
-    gt_last_pitches = [pitch for start, end, pitch in gt_notes if abs(start - last_gt_time) < epsilon]
-    print(f"[GT Last Anchor] Time = {last_gt_time:.3f}, Pitches = {gt_last_pitches}")
+    last_gt_time = gt_index.onsets[-1]
+    gt_last_pitches = gt_index.group_at(last_gt_time)
+    logger.info(f"[GT Last Anchor] Time = {last_gt_time:.3f}, Pitches = {gt_last_pitches}")
+
+    # scan back from the end down to the first anchor: the latest group over threshold wins
+    tr_onsets = tr_index.onsets
+    lo = bisect_left(tr_onsets, first_aligned_time)
+    k, _, scanned = first_match(gt_index.pitch_masks()[-1], tr_index.pitch_masks()[lo:, 0, :], THRESH_LAST, reverse=True)
+    tally(counts, "candidates", scanned)
 
-    trans_sorted_rev = sorted(transkun_notes, key=lambda x: -x[0])
     last_aligned_time = None
-    for s, e, p in trans_sorted_rev:
-        current_time = s
-        if current_time < first_aligned_time:
-            break
-        tr_group = group_at_time(transkun_notes, current_time, epsilon)
-        if not gt_last_pitches:
-            continue
-        ratio = group_match_ratio(gt_last_pitches, tr_group)
-        if ratio >= THRESH_LAST:
-            last_aligned_time = current_time
-            print(f"[Last Anchor Match] Transkun time = {current_time:.3f}, Pitches at this time = {tr_group}")
-            break
+    if k is not None:
+        last_aligned_time = tr_onsets[lo + k]
+        logger.info(f"[Last Anchor Match] Transkun time = {last_aligned_time:.3f}, Pitches at this time = {tr_index.group_at(last_aligned_time)}")
     if last_aligned_time is None:
         raise RuntimeError("Failed to find matching last anchor in Transkun MIDI.")
     return (last_gt_time, gt_last_pitches, last_aligned_time, None, 1.0, gt_last_pitches)
 
-# ========== bi-directional sliding sequence match ==========
-def sequences_match_with_bi_sliding(
-    gt_seq, tr_seq,
+# ========== batched bi-sliding sequence match (pitch masks) ==========
+def match_sequences_batched(
+    gt_seq, gt_index, tr_index,
+    cand_lo, cand_hi,
     per_group_thresh,
     seq_len=5,
     max_skip_gt=2,
     max_skip_tr=2,
+    max_span=10.0,
+    max_hits=1,
+    counts=None,
 ):
     """
-    Try all (skip_gt, skip_tr) pairs within [0, max_skip_*] and compare exactly `seq_len` groups:
-        gt window = gt_seq[skip_gt : skip_gt + seq_len]
-        tr window = tr_seq[skip_tr : skip_tr + seq_len]
-    Each group's |n|/|GT| must be >= per_group_thresh.
-    Returns: (ok, skip_gt, skip_tr, ratios[list of length seq_len])
+    Bi-directional sliding sequence match over Transkun candidates
+    tr_index.onsets[cand_lo:cand_hi], each with its own collect_group_sequence.
+    For every candidate, all (skip_gt, skip_tr) pairs within [0, max_skip_*] compare
+    exactly `seq_len` groups (gt_seq[skip_gt:], TR sequence from skip_tr); a pair is
+    valid when each group's |GT & TR| / |GT| >= per_group_thresh (popcounts of pitch
+    masks), and the first valid pair in (skip_gt, skip_tr) order wins. Candidates are
+    scored in batches of `match_batch` (all candidates x all skip pairs per array op)
+    until `max_hits` valid candidates are found.
+    Returns: list[(tr_seq_start, skip_gt, skip_tr, ratios)] in candidate order,
+    where tr_seq_start indexes tr_index.onsets.
     """
-    if len(gt_seq) < 1 or len(tr_seq) < 1:
-        return False, -1, -1, []
+    n_gt = len(gt_seq)
+    if n_gt < 1 or cand_hi <= cand_lo:
+        return []
 
-    for skip_gt in range(0, max_skip_gt + 1):
-        if len(gt_seq) < skip_gt + seq_len:
-            continue
-        for skip_tr in range(0, max_skip_tr + 1):
-            if len(tr_seq) < skip_tr + seq_len:
-                continue
+    # GT side: (n_gt, layers, 2) masks and per-group sizes
+    gt_pos = [bisect_left(gt_index.onsets, t) for t, _ in gt_seq]
+    gt_masks = gt_index.pitch_masks()[gt_pos]
+    gt_size = popcount(gt_masks).sum(axis=(1, 2)).astype(np.int64)
+
+    onsets = tr_index.onset_array
+    tr_masks = tr_index.pitch_masks()[:, 0, :]   # TR groups only need membership
+    n_tr = len(onsets)
+    width = max(seq_len + max_skip_tr, 1)
+    offs = np.arange(width)
+
+    # (skip_gt, skip_tr) pairs in priority order, with per-pair group indices
+    pairs = [(sg, st) for sg in range(max_skip_gt + 1) for st in range(max_skip_tr + 1)]
+    pair_gt = np.array([[sg + j for j in range(seq_len)] for sg, _ in pairs], dtype=np.intp)
+    pair_tr = np.array([[st + j for j in range(seq_len)] for _, st in pairs], dtype=np.intp)
+    pair_need_gt = np.array([sg + seq_len for sg, _ in pairs])
+    pair_need_tr = np.array([st + seq_len for _, st in pairs])
+    pair_gt_ok = pair_need_gt <= n_gt
+    if not pair_gt_ok.any():
+        return []
+    pair_gt = np.minimum(pair_gt, n_gt - 1)
+    pair_tr = np.minimum(pair_tr, width - 1)
+
+    hits = []
+    for lo in range(cand_lo, cand_hi, match_batch):
+        cand = np.arange(lo, min(lo + match_batch, cand_hi))
+        tally(counts, "candidates", len(cand))
+
+        # TR sequence per candidate: consecutive onsets from the first >= t - eps, within max_span
+        seq_start = np.searchsorted(onsets, onsets[cand] - tr_index.epsilon, side="left")
+        idx = seq_start[:, None] + offs[None, :]
+        in_range = idx < n_tr
+        idx = np.minimum(idx, n_tr - 1)
+        in_span = in_range & ((onsets[idx] - onsets[seq_start][:, None]) <= max_span)
+        seq_count = np.logical_and.accumulate(in_span, axis=1).sum(axis=1)
+
+        # |GT_g & TR_o| for every candidate, GT group g and TR offset o: (C, n_gt, width)
+        inter = popcount(gt_masks[None, :, None, :, :] & tr_masks[idx][:, None, :, None, :])
+        inter = inter.sum(axis=(3, 4)).astype(np.int64)
+        ratios = inter[:, pair_gt, pair_tr] / gt_size[pair_gt]          # (C, pairs, seq_len)
 
-            ratios = []
-            ok = True
-            for (_, g_gt), (_, g_tr) in zip(
-                gt_seq[skip_gt : skip_gt + seq_len],
-                tr_seq[skip_tr : skip_tr + seq_len]
-            ):
-                if not g_gt:
-                    ok = False
-                    break
-                inter = sum(1 for p in g_gt if p in g_tr)
-                r = inter / len(g_gt)
-                ratios.append(r)
-                if r < per_group_thresh:
-                    ok = False
-                    break
-            if ok:
-                return True, skip_gt, skip_tr, ratios
-
-    return False, -1, -1, []
+        ok = (np.all(ratios >= per_group_thresh, axis=2)
+              & pair_gt_ok[None, :]
+              & (seq_count[:, None] >= pair_need_tr[None, :])
+              & (seq_count[:, None] >= seq_len))
+        for c in np.flatnonzero(ok.any(axis=1)):
+            k = int(np.argmax(ok[c]))
+            sg, st = pairs[k]
+            hits.append((int(seq_start[c]), sg, st, ratios[c, k].tolist()))
+            if len(hits) >= max_hits:
+                return hits
+    return hits
 
 # ========== middle anchors: expected-offset windows + bi-sliding sequence ==========
 def find_segment_anchor_sequence_expected(
-    gt_notes, transkun_notes,
-    seg_start_gt_time, epsilon,
+    gt_index, tr_index,
+    seg_start_gt_time,
     center, back, fwd,
-    prev_trans_time
+    prev_trans_time,
+    logger=log,
+    counts=None,
 ):
     """
     For this segment start:
@@ -230,123 +502,609 @@ def find_segment_anchor_sequence_expected(
             upper_bound = center + fwd
       - For each candidate time:
             collect TR sequence with extra groups; run bi-directional sliding comparison
-            (fixed seq_len, both sides can skip up to `max_skip_prefix`).
+            (fixed seq_len, both sides can skip up to `max_skip_prefix`), batched over
+            all candidates by `match_sequences_batched`.
       - First valid match wins; also print up to `extra_print_after` later valid candidates.
       - Anchor times use the *slid* positions (gt_seq[skip_gt].time, tr_seq[skip_tr].time).
     """
-    gt_groups = collect_gt_groups_from_time(gt_notes, seg_start_gt_time, epsilon, n_attempts)
-    trans_times = sorted({s for s, _, _ in transkun_notes})
+    gt_groups = collect_gt_groups_from_time(gt_index, seg_start_gt_time, n_attempts)
 
     # forward-only with small backward allowance + monotonic constraint
     lower_bound = center - back
     if prev_trans_time is not None:
         lower_bound = max(lower_bound, prev_trans_time + safety_forward)
     upper_bound = center + fwd
+    cand_lo = bisect_left(tr_index.onsets, lower_bound)
+    cand_hi = bisect_right(tr_index.onsets, upper_bound)
 
-    print(f"\n===== [Segment start @ {seg_start_gt_time:.3f}s] GT PITCH GROUPS (Top N) =====")
-    print(f"[Search window] Transkun: [{lower_bound:.3f}, {upper_bound:.3f}] (center={center:.3f}, back={back:.2f}, fwd={fwd:.2f})")
+    logger.info(f"\n===== [Segment start @ {seg_start_gt_time:.3f}s] GT PITCH GROUPS (Top N) =====")
+    logger.info(f"[Search window] Transkun: [{lower_bound:.3f}, {upper_bound:.3f}] (center={center:.3f}, back={back:.2f}, fwd={fwd:.2f})")
 
     for i, (t_gt, gt_group) in enumerate(gt_groups):
-        print(f"Group {i+1}: Time = {t_gt:.3f}, GT Pitches = {sorted(gt_group)}")
+        logger.info(f"Group {i+1}: Time = {t_gt:.3f}, GT Pitches = {sorted(gt_group)}")
 
         # Prepare GT sequence with extra groups for sliding
         gt_seq = collect_group_sequence(
-            gt_notes, t_gt, epsilon,
+            gt_index, t_gt,
             max_groups=seq_len + max_skip_prefix,  # allow skipping while still comparing seq_len groups
             max_span=seq_max_span
         )
         if len(gt_seq) < seq_len:
-            print("  Skipping: GT pattern too short for sequence matching.")
+            logger.info("  Skipping: GT pattern too short for sequence matching.")
             continue
 
+        # Score every trans candidate in window x every (skip_gt, skip_tr) pair at once
+        hits = match_sequences_batched(
+            gt_seq, gt_index, tr_index,
+            cand_lo, cand_hi,
+            per_group_thresh=THRESH_MIDDLE,
+            seq_len=seq_len,
+            max_skip_gt=max_skip_prefix,
+            max_skip_tr=max_skip_prefix,
+            max_span=seq_max_span,
+            max_hits=1 + extra_print_after,
+            counts=counts,
+        )
+
         first_valid = None
         extra = []
+        for tr_start, skip_gt, skip_tr, ratios in hits:
+            anchor_gt_time = gt_seq[skip_gt][0]
+            anchor_tr_time = tr_index.onsets[tr_start + skip_tr]
 
-        # Scan trans candidates in window
-        for t_trans in trans_times:
-            if t_trans < lower_bound or t_trans > upper_bound:
-                continue
-
-            # Build TR sequence with extra groups for sliding
-            tr_seq = collect_group_sequence(
-                transkun_notes, t_trans, epsilon,
-                max_groups=seq_len + max_skip_prefix,
-                max_span=seq_max_span
-            )
-            if len(tr_seq) < seq_len:
-                continue
-
-            # Bi-directional sliding sequence match
-            ok, skip_gt, skip_tr, ratios = sequences_match_with_bi_sliding(
-                gt_seq, tr_seq,
-                per_group_thresh=THRESH_MIDDLE,
-                seq_len=seq_len,
-                max_skip_gt=max_skip_prefix,
-                max_skip_tr=max_skip_prefix
-            )
-            if ok:
-                anchor_gt_time = gt_seq[skip_gt][0]
-                anchor_tr_time = tr_seq[skip_tr][0]
-
-                if first_valid is None:
-                    print(
-                        f"Matched (bi-slide gt={skip_gt}, tr={skip_tr}) at TR {anchor_tr_time:.3f}, "
-                        f"per-group={['%.2f' % r for r in ratios]}"
-                    )
-                    compared_tr_groups = [g for _, g in tr_seq[skip_tr : skip_tr + seq_len]]
-                    first_valid = (anchor_gt_time, gt_seq[skip_gt][1], anchor_tr_time, i+1, min(ratios), compared_tr_groups)
-                elif len(extra) < extra_print_after:
-                    extra.append((anchor_tr_time, skip_gt, skip_tr, ratios))
+            if first_valid is None:
+                logger.info(
+                    f"Matched (bi-slide gt={skip_gt}, tr={skip_tr}) at TR {anchor_tr_time:.3f}, "
+                    f"per-group={['%.2f' % r for r in ratios]}"
+                )
+                compared_tr_groups = [tr_index.group_at(t) for t in
+                                      tr_index.onsets[tr_start + skip_tr : tr_start + skip_tr + seq_len]]
+                first_valid = (anchor_gt_time, gt_seq[skip_gt][1], anchor_tr_time, i+1, min(ratios), compared_tr_groups)
+            else:
+                extra.append((anchor_tr_time, skip_gt, skip_tr, ratios))
 
         if first_valid is not None:
             if extra:
-                print(f"[Debug] Next sequence candidates (up to {extra_print_after}):")
+                logger.info(f"[Debug] Next sequence candidates (up to {extra_print_after}):")
                 for t_c, sgt, str_, rs in extra:
-                    print(f"  - @ TR {t_c:.3f}, skip_gt={sgt}, skip_tr={str_}, per-group={['%.2f'%r for r in rs]}")
+                    logger.info(f"  - @ TR {t_c:.3f}, skip_gt={sgt}, skip_tr={str_}, per-group={['%.2f'%r for r in rs]}")
             return first_valid
 
-        print("No bi-sliding sequence-level match for this GT group within window.")
+        logger.info("No bi-sliding sequence-level match for this GT group within window.")
+    return None
+
+# ========== middle anchors: coarse-to-fine over the whole Transkun timeline ==========
+def coarse_candidates_for(gt_index, tr_index, seg_start_gt_time, lower_bound, until=None, counts=None,
+                          center=None, upper_bound=None):
+    """
+    Rank Transkun positions for the GT signature at `seg_start_gt_time`: onset counts per
+    (coarse_hop frame, pitch) over coarse_span seconds, compared by cosine similarity at
+    every frame offset of the Transkun timeline in one array operation. Returns up to
+    `coarse_candidates` (trans_time, score) pairs in [lower_bound, upper_bound], best first,
+    at least one signature length apart. With an expected position `center`, scores lose
+    coarse_distance_penalty per minute away from it, so a repeated section later in the
+    piece does not beat a near-equal match where the segment should be. `until` caps the
+    signatures at settled Transkun time.
+    """
+    hop = coarse_hop
+    L = max(1, int(round(coarse_span / hop)))
+    gt_hist = gt_index.onset_histogram(hop)
+    tr_hist = tr_index.onset_histogram(hop)
+    j0 = int(seg_start_gt_time / hop)
+    template = gt_hist[j0:j0 + L]
+    if until is not None:
+        tr_hist = tr_hist[:max(0, int(until / hop) + 1)]
+    if len(template) < L or len(tr_hist) < L or not template.any():
+        return []
+
+    windows = np.lib.stride_tricks.sliding_window_view(tr_hist, L, axis=0)   # (n, 128, L)
+    dot = np.einsum("npl,lp->n", windows, template)
+    energy = np.concatenate([[0.0], np.cumsum((tr_hist ** 2).sum(axis=1))])
+    norm = np.sqrt(energy[L:] - energy[:-L]) * np.sqrt((template ** 2).sum())
+    score = np.where(norm > 0, dot / np.maximum(norm, 1e-12), 0.0)
+    tally(counts, "coarse_positions", len(score))
+
+    # frame j of Transkun lines up with GT frame j0; keep the sub-frame offset of the segment start
+    shift = seg_start_gt_time - j0 * hop
+    first = int(max(0.0, np.ceil((lower_bound - shift) / hop)))   # lower_bound may be -inf
+    last = len(score) if upper_bound is None else int(max(0.0, np.floor((upper_bound - shift) / hop) + 1))
+    rank = score[first:last]
+    if center is not None:
+        times = np.arange(first, first + len(rank)) * hop + shift
+        rank = rank - coarse_distance_penalty * np.abs(times - center) / 60.0
+    picked = []
+    for j in (np.argsort(-rank, kind="stable") + first).tolist():
+        if rank[j - first] <= 0 or len(picked) >= coarse_candidates:
+            break
+        if all(abs(j - k) >= L for k in picked):
+            picked.append(j)
+    return [(j * hop + shift, float(score[j])) for j in picked]
+
+def find_segment_anchor_coarse_to_fine(
+    gt_index, tr_index,
+    seg_start_gt_time,
+    prev_trans_time,
+    logger=log,
+    until=None,
+    counts=None,
+    center=None,
+    upper_bound=None,
+):
+    """
+    Coarse-to-fine middle anchor: rank positions over the whole Transkun timeline with
+    `coarse_candidates_for`, then run the exact sequence search in a +/- coarse_refine
+    window around each (forward extended to cover the GT groups tried), best coarse score first. Exact cost no longer depends on how far
+    the recording drifted from the expected offset. `center` (the expected Transkun time)
+    penalises far candidates and `upper_bound` drops those past it, e.g. the next segment's
+    expected time plus max_fwd; it also caps the refine windows and the anchors they return.
+    """
+    lower_bound = float("-inf") if prev_trans_time is None else prev_trans_time + safety_forward
+    tally(counts, "coarse_searches")
+    candidates = coarse_candidates_for(gt_index, tr_index, seg_start_gt_time, lower_bound, until, counts,
+                                       center=center, upper_bound=upper_bound)
+    logger.info(f"[Coarse] {len(candidates)} candidate positions for GT {seg_start_gt_time:.3f}s: "
+                + ", ".join(f"{t:.2f}s ({score:.2f})" for t, score in candidates))
+    # the exact search tries the first n_attempts GT groups, which may start a little later
+    gt_groups = collect_gt_groups_from_time(gt_index, seg_start_gt_time, n_attempts)
+    lead = max(0.0, gt_groups[-1][0] - seg_start_gt_time) if gt_groups else 0.0
+    for center, _ in candidates:
+        fwd = coarse_refine + lead
+        if upper_bound is not None:
+            fwd = min(fwd, upper_bound - center)
+        seg_anchor = find_segment_anchor_sequence_expected(
+            gt_index, tr_index,
+            seg_start_gt_time=seg_start_gt_time,
+            center=center,
+            back=coarse_refine,
+            fwd=fwd,
+            prev_trans_time=prev_trans_time,
+            logger=logger,
+            counts=counts,
+        )
+        if seg_anchor is not None and not anchor_past(seg_anchor, upper_bound, logger):
+            return seg_anchor
     return None
 
+def anchor_past(seg_anchor, upper_bound, logger=log):
+    """True (and logged) if the anchor's Transkun time lies past `upper_bound` (None = no bound)."""
+    if upper_bound is None or seg_anchor[2] <= upper_bound:
+        return False
+    logger.info(f"[Info] Match at TR {seg_anchor[2]:.3f}s lies past the bound {upper_bound:.3f}s; rejected.")
+    return True
+
+def find_middle_anchor(gt_index, tr_index, seg_start, center, back, fwd, prev_trans_time, logger=log, until=None,
+                       counts=None, upper_bound=None):
+    """
+    Expected-offset window search (per `anchor_search`), coarse-to-fine if it misses; None if
+    both fail. `until` caps the Transkun signatures of the coarse search, whose candidates
+    are ranked by distance to `center` too; no anchor returned lies past `upper_bound`.
+    """
+    seg_anchor = None
+    if anchor_search == "window":
+        seg_anchor = find_segment_anchor_sequence_expected(
+            gt_index, tr_index,
+            seg_start_gt_time=seg_start,
+            center=center,
+            back=back,
+            fwd=fwd,
+            prev_trans_time=prev_trans_time,
+            logger=logger,
+            counts=counts,
+        )
+        if seg_anchor is not None and anchor_past(seg_anchor, upper_bound, logger):
+            seg_anchor = None
+        if seg_anchor is None:
+            logger.info("[Info] No match in expected window; coarse-to-fine search over the whole Transkun timeline.")
+
+    if seg_anchor is None:
+        seg_anchor = find_segment_anchor_coarse_to_fine(
+            gt_index, tr_index,
+            seg_start_gt_time=seg_start,
+            prev_trans_time=prev_trans_time,
+            logger=logger,
+            until=until,
+            counts=counts,
+            center=center,
+            upper_bound=upper_bound,
+        )
+    return seg_anchor
+
+# ========== middle anchors: speculative parallel windows ==========
+_spec_indexes = None   # (gt_index, tr_index) inherited by forked workers
+
+class _LineBuffer(logging.Handler):
+    """Collects a search's log messages so they can be replayed in segment order."""
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(record.getMessage())
+
+def _speculative_window(job):
+    """Expected-window search for one segment without the previous anchor's bound."""
+    seg_start, center, back, fwd = job
+    gt_index, tr_index = _spec_indexes
+    buffer = _LineBuffer()
+    logger = logging.Logger("correction.speculative")
+    logger.addHandler(buffer)
+    counts = {}
+    t0 = time.perf_counter()
+    anchor = find_segment_anchor_sequence_expected(gt_index, tr_index, seg_start, center, back, fwd,
+                                                   prev_trans_time=None, logger=logger, counts=counts)
+    return anchor, buffer.lines, counts, time.perf_counter() - t0
+
+def speculative_windows(gt_index, tr_index, jobs, n_jobs):
+    """
+    Run `_speculative_window` for every (seg_start, center, back, fwd) of `jobs` on `n_jobs`
+    workers: forked processes sharing the indexes copy-on-write, threads where fork is
+    unavailable. Returns the results in segment order.
+    """
+    global _spec_indexes
+    gt_index.pitch_masks()
+    tr_index.pitch_masks()
+    _spec_indexes = (gt_index, tr_index)
+    try:
+        if "fork" in multiprocessing.get_all_start_methods():
+            pool = ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("fork"))
+        else:
+            pool = ThreadPoolExecutor(max_workers=n_jobs)
+        with pool:
+            return list(pool.map(_speculative_window, jobs))
+    finally:
+        _spec_indexes = None
+
+# ========== adaptive segmentation ==========
+def pitch_onset_keys(index):
+    """Sorted pitch * PITCH_STRIDE + onset keys of an OnsetIndex, for nearest same-pitch lookups."""
+    return np.sort(np.asarray(index.pitches, dtype=np.float64) * PITCH_STRIDE + np.asarray(index.starts))
+
+def segment_residual(gt_index, tr_keys, seg_start, seg_end, a, b):
+    """
+    Median |a * t + b - nearest Transkun onset of the same pitch| over the GT notes with
+    onsets in [seg_start, seg_end), counting onsets within `residual_match` only.
+    Returns (residual, matched fraction); residual is inf when less than half match.
+    """
+    lo, hi = bisect_left(gt_index.starts, seg_start), bisect_left(gt_index.starts, seg_end)
+    if hi <= lo or len(tr_keys) == 0:
+        return float("inf"), 0.0
+    mapped = a * np.asarray(gt_index.starts[lo:hi]) + b
+    keys = np.asarray(gt_index.pitches[lo:hi], dtype=np.float64) * PITCH_STRIDE + mapped
+    j = np.searchsorted(tr_keys, keys)
+    nearest = np.minimum(np.abs(tr_keys[np.minimum(j, len(tr_keys) - 1)] - keys),
+                         np.abs(tr_keys[np.maximum(j - 1, 0)] - keys))
+    matched = nearest[nearest <= residual_match]
+    frac = len(matched) / len(nearest)
+    if frac < 0.5:
+        return float("inf"), frac
+    return float(np.median(matched)), frac
+
+def refine_segments(gt_index, tr_index, anchors, segments, logger=log, stats=None):
+    """
+    Adaptive mode: halve every segment whose linear mapping leaves a median onset residual
+    above `residual_tol`, searching the new anchor in a narrow window around the mapped
+    midpoint (coarse-to-fine if that misses) between the neighbouring anchors. Segments
+    shorter than 2 * min_segment_seconds, or whose midpoint anchor is not found, keep their
+    mapping. Updates both lists in place; `stats` (a list) receives one entry per check.
+    """
+    tr_keys = pitch_onset_keys(tr_index)
+    i = 0
+    while i < len(segments):
+        seg_start, seg_end = segments[i]
+        (a, b), = [m[2:] for m in build_mappings(anchors[i:i + 2], [segments[i]], logger=_silent)]
+        t0 = time.perf_counter()
+        residual, frac = segment_residual(gt_index, tr_keys, seg_start, seg_end, a, b)
+        logger.info(f"[Adaptive] GT {seg_start:.2f}-{seg_end:.2f}s: residual {residual * 1000:.1f} ms ({frac:.0%} matched)")
+        counts = {"gt_start": seg_start, "gt_end": seg_end, "residual": residual, "split": False}
+        if stats is not None:
+            stats.append(counts)
+        if residual <= residual_tol or seg_end - seg_start < 2 * min_segment_seconds:
+            counts["time"] = time.perf_counter() - t0
+            i += 1
+            continue
+
+        mid = (seg_start + seg_end) / 2
+        prev_trans_time, next_trans_time = anchors[i][2], anchors[i + 1][2]
+        # candidates must start before the next anchor; coarse signatures may reach past it
+        seg_anchor = find_middle_anchor(gt_index, tr_index, mid, a * mid + b, min_back, min_fwd, prev_trans_time,
+                                        logger, until=next_trans_time - safety_forward + coarse_span, counts=counts,
+                                        upper_bound=next_trans_time - safety_forward)
+        counts["time"] = time.perf_counter() - t0
+        if seg_anchor is None or seg_anchor[2] > next_trans_time - safety_forward or seg_anchor[0] >= seg_end:
+            logger.info(f"[Adaptive] No anchor near GT {mid:.2f}s; keeping segment {seg_start:.2f}-{seg_end:.2f}s.")
+            i += 1
+            continue
+        logger.info(f"[Adaptive] Split at GT {mid:.2f}s (anchor TR {seg_anchor[2]:.3f}s)")
+        counts["split"] = True
+        segments[i:i + 1] = [(seg_start, mid), (mid, seg_end)]
+        anchors.insert(i + 1, seg_anchor)
+    return anchors, segments
+
+# ========== note-level refinement ==========
+def band_columns(prior, tr_onsets, band, max_band):
+    """
+    Per GT group, the first Transkun group of its band (monotone) and the band width:
+    groups within `band` seconds of the prior, at most `max_band` of them (nearest kept).
+    Returns (lo, hi, width) with hi the exclusive end of the valid part of each row.
+    """
+    lo = np.searchsorted(tr_onsets, prior - band, side="left")
+    hi = np.searchsorted(tr_onsets, prior + band, side="right")
+    width = int(clamp(1, int((hi - lo).max(initial=0)), max_band))
+    wide = hi - lo > width
+    if wide.any():
+        near = np.searchsorted(tr_onsets, prior[wide])
+        lo[wide] = np.clip(near - width // 2, lo[wide], hi[wide] - width)
+        hi[wide] = lo[wide] + width
+    # the DP walks both timelines forward, so row starts must not move back
+    lo = np.maximum.accumulate(lo)
+    hi = np.maximum(hi, lo)
+    return lo, hi, width
+
+def band_scores(gt_index, tr_index, prior, lo, hi, width):
+    """
+    (n_gt, width) pair scores: match ratio minus a distance penalty (up to 0.5 at the band
+    edge), -inf where the groups may not be paired (ratio below refine_min_ratio, outside band).
+    """
+    gt_masks = gt_index.pitch_masks()
+    gt_size = popcount(gt_masks).sum(axis=(1, 2)).astype(np.float64)
+    tr_masks = tr_index.pitch_masks()[:, 0, :]
+    tr_onsets = tr_index.onset_array
+    scores = np.full((len(prior), width), -np.inf)
+    for r0 in range(0, len(prior), match_batch):
+        rows = slice(r0, min(r0 + match_batch, len(prior)))
+        cols = lo[rows, None] + np.arange(width)
+        valid = cols < hi[rows, None]
+        cols = np.minimum(cols, len(tr_onsets) - 1)
+        inter = popcount(gt_masks[rows][:, None, :, :] & tr_masks[cols][:, :, None, :]).sum(axis=(2, 3))
+        ratio = inter / np.maximum(gt_size[rows], 1)[:, None]
+        dist = np.abs(tr_onsets[cols] - prior[rows, None]) / refine_band
+        ok = valid & (ratio >= refine_min_ratio) & (gt_size[rows] > 0)[:, None]
+        scores[rows] = np.where(ok, ratio - 0.5 * dist, -np.inf)
+    return scores
+
+def banded_match(scores, lo):
+    """
+    Monotone one-to-one pairing of GT rows with Transkun columns maximizing the total score
+    (skips are free), restricted to each row's band [lo, lo + width). The DP keeps one band
+    row at a time; a row is the running max over its band of max(skip GT, pair diagonally),
+    so time and backpointer memory are O(n_gt * width). Returns [(gt_row, tr_column)] ascending.
+    """
+    n, width = scores.shape
+    if n == 0:
+        return []
+    src = np.empty((n, width), dtype=np.int32)
+    paired = np.empty((n, width), dtype=bool)
+    offs = np.arange(width)
+    # previous DP row over its band, extended by the value left of the band (carried in from
+    # earlier rows) and, right of it, its last value repeated (skipped Transkun columns)
+    ext = np.zeros(2 * width + 1)
+    lo = [int(x) for x in lo]
+    prev_lo = lo[0]
+    for i in range(n):
+        shift = min(lo[i] - prev_lo, width)
+        up, diag = ext[shift + 1:shift + 1 + width], ext[shift:shift + width] + scores[i]
+        take = diag > up
+        cand = np.where(take, diag, up)
+        row = np.maximum.accumulate(cand)
+        src[i] = np.maximum.accumulate(np.where(cand == row, offs, 0))
+        paired[i] = take
+        ext[0] = ext[shift]
+        ext[1:width + 1] = row
+        ext[width + 1:] = row[-1]
+        prev_lo = lo[i]
+
+    pairs = []
+    j = lo[-1] + width - 1
+    for i in range(n - 1, -1, -1):
+        r = j - lo[i]
+        if r < 0:
+            continue
+        k = int(src[i, min(r, width - 1)])
+        if paired[i, k]:
+            pairs.append((i, lo[i] + k))
+            j = lo[i] + k - 1
+        else:
+            j = lo[i] + k
+    return pairs[::-1]
+
+OUTLIER_PAIRS = 11
+
+def consistent_pairs(shift):
+    """Mask of pairs whose shift lies within refine_outlier of the running median of OUTLIER_PAIRS pairs."""
+    if len(shift) < OUTLIER_PAIRS:
+        return np.abs(shift - np.median(shift)) <= refine_outlier if len(shift) else np.zeros(0, bool)
+    padded = np.pad(shift, OUTLIER_PAIRS // 2, mode="edge")
+    median = np.median(np.lib.stride_tricks.sliding_window_view(padded, OUTLIER_PAIRS), axis=1)
+    return np.abs(shift - median) <= refine_outlier
+
+def knot_mappings(mappings, gt_times, tr_times):
+    """
+    Thin matched (gt, tr) onset pairs to knots at least refine_knot_spacing apart with local
+    slopes in [1/refine_max_slope, refine_max_slope] and return (seg_start, seg_end, a, b) per
+    knot interval; the outer intervals extend to the domain of the segment `mappings`.
+    Fewer than two knots leave `mappings` as they are.
+    """
+    dom_start, dom_end = mappings[0][0], mappings[-1][1]
+    knots = []
+    for g, t in zip(gt_times, tr_times):
+        if not dom_start <= g <= dom_end:
+            continue
+        if knots:
+            g0, t0 = knots[-1]
+            if g - g0 < refine_knot_spacing or not 1.0 / refine_max_slope <= (t - t0) / (g - g0) <= refine_max_slope:
+                continue
+        knots.append((g, t))
+    if len(knots) < 2:
+        return list(mappings)
+
+    refined = []
+    for (g0, t0), (g1, t1) in zip(knots, knots[1:]):
+        a = (t1 - t0) / (g1 - g0)
+        refined.append((g0, g1, a, t0 - a * g0))
+    refined[0] = (dom_start,) + refined[0][1:]
+    refined[-1] = refined[-1][:1] + (dom_end,) + refined[-1][2:]
+    return refined
+
+def refine_mappings(gt_index, tr_index, mappings, epsilon, logger=log, stats=None):
+    """
+    Note-level pass over the segment mappings: map every GT onset group with them (the prior),
+    pair GT and Transkun groups by banded DP within `refine_band` of it and return the
+    monotone knot mappings through the paired onsets. `stats` (a dict) receives the counts.
+    """
+    coarse = TimeWarp(mappings, epsilon)
+    gt_onsets = gt_index.onset_array
+    prior = coarse.apply_times(gt_onsets)
+    lo, hi, width = band_columns(prior, tr_index.onset_array, refine_band, refine_max_band)
+    pairs = banded_match(band_scores(gt_index, tr_index, prior, lo, hi, width), lo)
+    gi = np.array([i for i, _ in pairs], dtype=np.intp)
+    tj = np.array([j for _, j in pairs], dtype=np.intp)
+    shift = tr_index.onset_array[tj] - prior[gi]
+    keep = consistent_pairs(shift)
+    refined = knot_mappings(mappings, gt_onsets[gi[keep]].tolist(), tr_index.onset_array[tj[keep]].tolist())
+    median_shift = float(np.median(np.abs(shift[keep]))) if keep.any() else 0.0
+    logger.info(f"[Refine] {int(keep.sum())}/{len(gt_onsets)} GT onset groups paired (band {width} groups, "
+                f"{len(pairs) - int(keep.sum())} outliers dropped), median shift from segment mapping "
+                f"{median_shift * 1000:.1f} ms, {len(refined)} knot intervals")
+    if stats is not None:
+        stats.update({"groups": len(gt_onsets), "paired": int(keep.sum()), "outliers": len(pairs) - int(keep.sum()),
+                      "band": width, "knots": len(refined) + 1, "median_shift": median_shift})
+    return refined
+
 # ========== main ==========
-def align_gt_to_transkun(gt_midi_path, transkun_midi_path, output_path, epsilon=0.01):
-    print(f"Running alignment with epsilon = {epsilon}")
-    gt_notes, gt_midi = extract_notes(gt_midi_path)
-    transkun_notes, _ = extract_notes(transkun_midi_path)
+@dataclass
+class AlignmentResult:
+    """
+    Outcome of one GT -> Transkun alignment.
+      anchors  : [first, middle..., last], each (gt_time, gt_pitches, trans_time, group_idx, ratio, trans_pitches)
+      mappings : per GT segment (seg_start, seg_end, a, b), trans_time = a * gt_time + b
+                 (per knot interval with note_refine)
+      timings  : seconds spent per phase
+      stats    : per phase Transkun candidates scanned and seconds spent:
+                 {"first_anchor": {...}, "last_anchor": {...}, "segments": [per middle anchor],
+                  "adaptive": [per residual check], "refine": {...}}, see `stats_lines`
+    """
+    epsilon: float
+    anchors: list
+    mappings: list
+    timings: dict = field(default_factory=dict)
+    stats: dict = field(default_factory=dict)
+
+    @property
+    def segments(self):
+        return [(s, e) for s, e, _, _ in self.mappings]
+
+    @property
+    def ratios(self):
+        """Match ratio of each anchor, in anchor order."""
+        return [anchor[4] for anchor in self.anchors]
+
+    def stats_lines(self):
+        """Human-readable search statistics, one line per phase / segment."""
+        lines = []
+        for phase in ("first_anchor", "last_anchor"):
+            st = self.stats.get(phase)
+            if st:
+                lines.append(f"{phase:<19}: {st.get('candidates', 0):>6} candidates  {st.get('time', 0.0):8.3f}s")
+        for kind in ("segments", "adaptive"):
+            for st in self.stats.get(kind, []):
+                label = "segment" if kind == "segments" else "residual"
+                extra = ""
+                if st.get("coarse_searches"):
+                    extra += f"  coarse ({st.get('coarse_positions', 0)} positions)"
+                if kind == "adaptive":
+                    extra += f"  residual {st['residual'] * 1000:.1f} ms" + ("  split" if st["split"] else "")
+                lines.append(f"{label} @ {st['gt_start']:8.2f}s: {st.get('candidates', 0):>6} candidates  "
+                             f"{st.get('time', 0.0):8.3f}s{extra}")
+        st = self.stats.get("refine")
+        if st:
+            lines.append(f"{'refine':<19}: {st['paired']:>6}/{st['groups']} groups paired, {st['knots']} knots  "
+                         f"{st.get('time', 0.0):8.3f}s")
+        lines.append(f"{'total':<19}: {self.timings.get('total', 0.0):8.3f}s")
+        return lines
 
-    total_time = max(n[0] for n in gt_notes)
-    segment_length = segment_minutes * 60.0
+    @property
+    def warp(self):
+        """The mappings as a warp.TimeWarp (save it to reuse the alignment elsewhere)."""
+        return TimeWarp.from_result(self)
 
-    # segments on GT
+def segment_gt_timeline(total_time, logger=log, segment_length=None):
+    """Cut the GT timeline into `segment_minutes` (or `segment_length` s) segments."""
+    segment_length = segment_length or segment_minutes * 60.0
     if total_time <= segment_length:
-        print("Song shorter than one segment, using single-segment alignment.")
-        segments = [(0.0, total_time)]
-    else:
-        segments = []
-        t = 0.0
-        while t < total_time:
-            segments.append((t, min(t + segment_length, total_time)))
-            t += segment_length
-        print(f"Total time: {total_time:.2f}s, segments: {len(segments)}")
+        logger.info("Song shorter than one segment, using single-segment alignment.")
+        return [(0.0, total_time)]
+    segments = []
+    t = 0.0
+    while t < total_time:
+        segments.append((t, min(t + segment_length, total_time)))
+        t += segment_length
+    logger.info(f"Total time: {total_time:.2f}s, segments: {len(segments)}")
+    return segments
+
+def build_mappings(anchors, segments, logger=log):
+    """Per-segment (seg_start, seg_end, a, b) from consecutive anchors [first, seg1, ..., last]."""
+    mappings = []
+    for i in range(len(segments)):
+        t0_gt, _, t0_tr, *_ = anchors[i]
+        t1_gt, _, t1_tr, *_ = anchors[i+1]
+        denom = (t1_gt - t0_gt)
+        if abs(denom) < min_denom:
+            if mappings:
+                a, b = mappings[-1][2], mappings[-1][3]
+                logger.info(f"\n[Segment {i+1}] degenerate anchor times; reusing previous mapping: a={a:.6f}, b={b:.6f}")
+            else:
+                a, b = 1.0, 0.0
+                logger.info(f"\n[Segment {i+1}] degenerate anchor times; using identity: a=1.000000, b=0.000000")
+        else:
+            a = (t1_tr - t0_tr) / denom
+            b = t0_tr - a * t0_gt
+            logger.info(f"\n[Segment {i+1}] GT {segments[i][0]:.2f}-{segments[i][1]:.2f}s => Mapping: a={a:.6f}, b={b:.6f}")
+        mappings.append((segments[i][0], segments[i][1], a, b))
+    return mappings
+
+def align(gt, transkun, epsilon=0.01, logger=log):
+    """
+    Align GT to Transkun in-process and return an AlignmentResult; nothing is written.
+    `gt` / `transkun` may be MIDI paths, PrettyMIDI objects or (start, end, pitch) note arrays.
+    """
+    timings = {}
+    t_start = time.perf_counter()
+    logger.info(f"Running alignment with epsilon = {epsilon}")
+
+    gt_index = OnsetIndex(as_notes(gt), epsilon)
+    tr_index = OnsetIndex(as_notes(transkun), epsilon)
+    timings["index"] = time.perf_counter() - t_start
+
+    total_time = gt_index.onsets[-1]
+    adaptive = segment_mode == "adaptive"
+    segments = segment_gt_timeline(total_time, logger, adaptive_minutes * 60.0 if adaptive else None)
 
     anchors = []
+    stats = {"first_anchor": {}, "last_anchor": {}, "segments": [], "adaptive": [], "refine": {}}
 
     # FIRST anchor (original)
-    first_anchor = find_first_anchor_original(gt_notes, transkun_notes, epsilon, n_attempts)
+    t0 = time.perf_counter()
+    first_anchor = find_first_anchor_original(gt_index, tr_index, n_attempts, logger=logger,
+                                              counts=stats["first_anchor"])
     anchors.append(first_anchor)
     first_gt_time, _, first_trans_time, _, _, _ = first_anchor
+    timings["first_anchor"] = stats["first_anchor"]["time"] = time.perf_counter() - t0
 
-    # LAST anchor (original) � we find it NOW to estimate end offset for expected model
-    print("\n===== [Final] GT Last Anchor =====")
-    last_anchor = find_last_anchor_original(gt_notes, transkun_notes, epsilon, first_trans_time)
+    # LAST anchor (original) - we find it NOW to estimate end offset for expected model
+    t0 = time.perf_counter()
+    logger.info("\n===== [Final] GT Last Anchor =====")
+    last_anchor = find_last_anchor_original(gt_index, tr_index, first_trans_time, logger=logger,
+                                            counts=stats["last_anchor"])
     anchors.append(last_anchor)  # append; middles will be inserted before this
+    timings["last_anchor"] = stats["last_anchor"]["time"] = time.perf_counter() - t0
 
     last_gt_time, _, last_trans_time, *_ = last_anchor
     O_end = last_trans_time - last_gt_time  # positive if Transkun is slower (GT "faster")
     T_total = last_gt_time
 
     # Middle anchors (insert between first and last)
-    prev_trans_time = first_trans_time
+    t0 = time.perf_counter()
+    windows, upper_bounds = [], []
     for idx in range(1, len(segments)):
         seg_start, seg_end = segments[idx]
 
@@ -358,70 +1116,94 @@ def align_gt_to_transkun(gt_midi_path, transkun_midi_path, output_path, epsilon=
         # scale windows from O_exp
         back = clamp(min_back,  scale_back * abs(O_exp), max_back)
         fwd  = clamp(min_fwd,   scale_fwd  * abs(O_exp), max_fwd)
+        windows.append((seg_start, center, back, fwd))
 
-        seg_anchor = find_segment_anchor_sequence_expected(
-            gt_notes, transkun_notes,
-            seg_start_gt_time=seg_start,
-            epsilon=epsilon,
-            center=center,
-            back=back,
-            fwd=fwd,
-            prev_trans_time=prev_trans_time
-        )
+        # no anchor may pass the next segment's expected start (plus max_fwd) or the last
+        # anchor, so a repeated section later in the piece cannot take it and the mapping stays monotone
+        next_center = seg_end + O_end * (seg_end / T_total if T_total > 0 else 0.0)
+        upper_bounds.append(min(next_center + max_fwd, last_trans_time - safety_forward))
 
-        if seg_anchor is None:
-            # one widening pass (only forward)
-            print("[Info] No match; widening forward window once (keep back from expected).")
-            seg_anchor = find_segment_anchor_sequence_expected(
-                gt_notes, transkun_notes,
-                seg_start_gt_time=seg_start,
-                epsilon=epsilon,
-                center=center,
-                back=back,
-                fwd=fwd * 1.5,
-                prev_trans_time=prev_trans_time
-            )
+    # The expected windows do not depend on earlier anchors, only their lower bound does:
+    # search them all in parallel without it, then keep every result whose window the
+    # previous anchor would not have cut (prev + safety_forward <= center - back), which
+    # makes it, and its log, exactly the sequential one. The rest are searched again below.
+    speculative = [None] * len(windows)
+    if anchor_jobs > 1 and anchor_search == "window" and len(windows) > 1:
+        speculative = speculative_windows(gt_index, tr_index, windows, min(anchor_jobs, len(windows)))
+
+    prev_trans_time = first_trans_time
+    for (seg_start, center, back, fwd), upper_bound, spec in zip(windows, upper_bounds, speculative):
+        t_seg = time.perf_counter()
+        counts = {"gt_start": seg_start}
+        stats["segments"].append(counts)
+        if spec is not None and prev_trans_time + safety_forward <= center - back:
+            seg_anchor, lines, spec_counts, spec_time = spec
+            for line in lines:
+                logger.info(line)
+            counts.update(spec_counts)
+            if seg_anchor is not None and anchor_past(seg_anchor, upper_bound, logger):
+                seg_anchor = None
             if seg_anchor is None:
-                raise RuntimeError(f"Failed to find anchor for segment starting at {seg_start:.3f}s")
+                logger.info("[Info] No match in expected window; coarse-to-fine search over the whole Transkun timeline.")
+                seg_anchor = find_segment_anchor_coarse_to_fine(gt_index, tr_index, seg_start, prev_trans_time,
+                                                                logger, counts=counts, center=center,
+                                                                upper_bound=upper_bound)
+            counts["time"] = spec_time + time.perf_counter() - t_seg
+        else:
+            seg_anchor = find_middle_anchor(gt_index, tr_index, seg_start, center, back, fwd, prev_trans_time, logger,
+                                            counts=counts, upper_bound=upper_bound)
+            counts["time"] = time.perf_counter() - t_seg
+        if seg_anchor is None:
+            raise RuntimeError(f"Failed to find anchor for segment starting at {seg_start:.3f}s")
 
         # insert this middle anchor before the last anchor
         anchors.insert(-1, seg_anchor)
         prev_trans_time = seg_anchor[2]
+    timings["middle_anchors"] = time.perf_counter() - t0
 
-    # Build per-segment mappings from consecutive anchors
-    mappings = []
-    # anchors order: [first, seg1, seg2, ..., last]
-    for i in range(len(segments)):
-        t0_gt, _, t0_tr, *_ = anchors[i]
-        t1_gt, _, t1_tr, *_ = anchors[i+1]
-        denom = (t1_gt - t0_gt)
-        if abs(denom) < min_denom:
-            if mappings:
-                a, b = mappings[-1][2], mappings[-1][3]
-                print(f"\n[Segment {i+1}] degenerate anchor times; reusing previous mapping: a={a:.6f}, b={b:.6f}")
-            else:
-                a, b = 1.0, 0.0
-                print(f"\n[Segment {i+1}] degenerate anchor times; using identity: a=1.000000, b=0.000000")
-        else:
-            a = (t1_tr - t0_tr) / denom
-            b = t0_tr - a * t0_gt
-            print(f"\n[Segment {i+1}] GT {segments[i][0]:.2f}-{segments[i][1]:.2f}s => Mapping: a={a:.6f}, b={b:.6f}")
-        mappings.append((segments[i][0], segments[i][1], a, b))
+    if adaptive:
+        t0 = time.perf_counter()
+        logger.info("\n===== [Adaptive] Residual-driven subdivision =====")
+        refine_segments(gt_index, tr_index, anchors, segments, logger, stats=stats["adaptive"])
+        timings["adaptive"] = time.perf_counter() - t0
+
+    mappings = build_mappings(anchors, segments, logger)
+    if note_refine:
+        t0 = time.perf_counter()
+        logger.info("\n===== [Refine] Banded note-level match =====")
+        mappings = refine_mappings(gt_index, tr_index, mappings, epsilon, logger, stats=stats["refine"])
+        timings["refine"] = stats["refine"]["time"] = time.perf_counter() - t0
+    timings["total"] = time.perf_counter() - t_start
+    return AlignmentResult(epsilon=epsilon, anchors=anchors, mappings=mappings, timings=timings, stats=stats)
+
+def apply_alignment(midi, result):
+    """
+    Warp every note of `midi` (PrettyMIDI, in place) with the result's segment mappings.
+    A note belongs to the first segment with seg_start <= start < seg_end + epsilon;
+    notes outside every segment are untouched.
+    """
+    return result.warp.apply_midi(midi, control_changes=False, extrapolate=False)
+
+def align_gt_to_transkun(gt_midi_path, transkun_midi_path, output_path, epsilon=0.01, logger=log, warp_path=None):
+    """
+    End-to-end: parse both files, align, write the warped GT MIDI to `output_path` and,
+    if `warp_path` is given, the time warp as a sidecar (.json or .npz) for warp.py.
+    """
+    gt_notes, gt_midi = extract_notes(gt_midi_path)
+    result = align(gt_notes, transkun_midi_path, epsilon=epsilon, logger=logger)
 
     # Apply mapping
-    for inst in gt_midi.instruments:
-        for note in inst.notes:
-            for seg_start, seg_end, a, b in mappings:
-                if seg_start <= note.start < seg_end + epsilon:
-                    note.start = a * note.start + b
-                    note.end   = a * note.end   + b
-                    break
+    apply_alignment(gt_midi, result)
 
     # Save
     output_path = Path(output_path)
     output_path.parent.mkdir(parents=True, exist_ok=True)
     gt_midi.write(str(output_path))
-    print(f"\nSaved aligned GT MIDI to: {output_path}")
+    logger.info(f"\nSaved aligned GT MIDI to: {output_path}")
+    if warp_path is not None:
+        result.warp.save(warp_path)
+        logger.info(f"Saved time warp to: {warp_path}")
+    return result
 
 # ==== CLI ====
 if __name__ == "__main__":
@@ -430,5 +1212,14 @@ if __name__ == "__main__":
     parser.add_argument("--transkun", type=str, required=True, help="Path to transkun MIDI file")
     parser.add_argument("--output", type=str, required=True, help="Path to save aligned GT MIDI")
     parser.add_argument("--epsilon", type=float, default=0.01, help="Time tolerance for grouping (default: 0.01s)")
+    parser.add_argument("--warp", type=str, default=None, help="Also save the time warp sidecar here (.json or .npz) for warp.py")
+    parser.add_argument("--stats", action="store_true", help="Print candidates scanned and time per anchor phase / segment")
+    parser.add_argument("--jobs", type=int, default=anchor_jobs, help="Worker processes for the speculative middle-anchor search (same result; default: 1)")
+    parser.add_argument("--quiet", action="store_true", help="Only log warnings and errors")
     args = parser.parse_args()
-    align_gt_to_transkun(args.gt, args.transkun, args.output, epsilon=args.epsilon)
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s", stream=sys.stdout)
+    anchor_jobs = args.jobs
+    result = align_gt_to_transkun(args.gt, args.transkun, args.output, epsilon=args.epsilon, warp_path=args.warp)
+    if args.stats:
+        print("\n===== Search statistics =====")
+        print("\n".join(result.stats_lines()))
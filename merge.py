@@ -1,29 +1,119 @@
+import argparse
+import os
+from pathlib import Path
 import pretty_midi
-import pygame
-import time
-
-# ????
-midi_path1 = "/storage/user/ljia/folder_for_share/output.mid"
-midi_path2 = "/storage/user/ljia/folder_for_share/case6/transkun_output.mid"
-merged_path = "/storage/user/ljia/folder_for_share/merged.mid"
-
-# ???? MIDI ??
-midi1 = pretty_midi.PrettyMIDI(midi_path1)
-midi2 = pretty_midi.PrettyMIDI(midi_path2)
-
-# ??? MIDI
-merged_midi = pretty_midi.PrettyMIDI()
-
-# ??? MIDI ??????
-inst1 = midi1.instruments[0]
-inst1.name = "Original"
-merged_midi.instruments.append(inst1)
-
-# ??? MIDI ??????
-inst2 = midi2.instruments[0]
-inst2.name = "Aligned"
-merged_midi.instruments.append(inst2)
-
-# ??????
-merged_midi.write(merged_path)
-print(f"? ????,??????:{merged_path}")
+
+from common import find_cases, map_cases
+from warp import load_warp
+
+MERGED_NAME = "merged.mid"
+
+
+# ========== sources ==========
+def parse_spec(spec):
+    """'LABEL=PATH' or 'PATH' (label = file stem) -> (label, path)."""
+    label, sep, path = spec.partition("=")
+    if not sep:
+        label, path = Path(spec).stem, spec
+    return label, path
+
+def track_name(label, inst, n_instruments):
+    """Track name in the merged file: the source label, plus the instrument when a source has several."""
+    if n_instruments == 1:
+        return label
+    name = inst.name.strip() or ("Drums" if inst.is_drum else pretty_midi.program_to_instrument_name(inst.program))
+    return f"{label}: {name}"
+
+def iter_tracks(sources, warps=None):
+    """
+    Yield (label, instrument) for every instrument of every source, in source order.
+    Sources are parsed one at a time and, if `warps` has an entry for their label,
+    warped on the fly (notes, CCs, pitch bends).
+    """
+    warps = warps or {}
+    for label, path in sources:
+        midi = pretty_midi.PrettyMIDI(str(path))
+        if label in warps:
+            load_warp(warps[label]).apply_midi(midi)
+        n = len(midi.instruments)
+        for inst in midi.instruments:
+            inst.name = track_name(label, inst, n)
+            yield label, inst
+        del midi
+
+def merge_midis(sources, output_path, warps=None):
+    """
+    Merge every instrument of every (label, path) source into one MIDI (one track per
+    source instrument) and write it to `output_path`. `warps` maps labels to a warp
+    sidecar / TimeWarp applied to that source first. The merged file is built in memory
+    before it is written. Returns the number of notes written.
+    """
+    merged = pretty_midi.PrettyMIDI()
+    for _, inst in iter_tracks(sources, warps):
+        merged.instruments.append(inst)
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    merged.write(str(output_path))
+    return sum(len(inst.notes) for inst in merged.instruments)
+
+
+# ========== directory trees ==========
+def is_current(output_path, inputs):
+    output_path = Path(output_path)
+    return output_path.exists() and all(Path(p).stat().st_mtime <= output_path.stat().st_mtime for p in inputs)
+
+def merge_case(case_dir, sources, warps=None, output_name=MERGED_NAME, force=False):
+    """Merge one case folder; source and warp paths are relative to it. Returns the notes written, None if up to date."""
+    case_dir = Path(case_dir)
+    case_sources = [(label, case_dir / path) for label, path in sources]
+    case_warps = {label: case_dir / path for label, path in (warps or {}).items()}
+    output_path = case_dir / output_name
+    if not force and is_current(output_path, [p for _, p in case_sources] + list(case_warps.values())):
+        return None
+    return merge_midis(case_sources, output_path, case_warps)
+
+def merge_tree(root, sources, warps=None, output_name=MERGED_NAME, jobs=1, force=False):
+    """
+    merge_case for every case folder under `root`, over `jobs` spawn processes.
+    Returns [(case_dir, notes written | None if up to date | exception)], in folder order.
+    """
+    cases = find_cases(root, [path for _, path in sources])
+    return map_cases(merge_case, cases, sources, warps, output_name, force, jobs=jobs)
+
+# === CLI entry ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge all tracks of several MIDI files into one comparison MIDI, for one set of files or every case folder of a tree.")
+    parser.add_argument("--source", action="append", required=True, metavar="[LABEL=]PATH", help="MIDI source, repeatable; the label names its tracks (default: file stem). With --tree, PATH is relative to each case folder")
+    parser.add_argument("--warp", action="append", default=[], metavar="LABEL=WARP", help="Warp sidecar (.json or .npz) applied to the source with this label, repeatable")
+    parser.add_argument("--output", type=str, default=None, help="Merged MIDI (single merge)")
+    parser.add_argument("--tree", type=str, default=None, help="Merge every folder under this root that holds all sources")
+    parser.add_argument("--output-name", type=str, default=MERGED_NAME, help=f"Merged file name inside each case folder (default: {MERGED_NAME})")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes for --tree (default: all cores)")
+    parser.add_argument("--force", action="store_true", help="Also rewrite merged files newer than their inputs")
+    args = parser.parse_args()
+
+    sources = [parse_spec(s) for s in args.source]
+    labels = [label for label, _ in sources]
+    if len(set(labels)) != len(labels):
+        parser.error(f"source labels must be unique, got {labels}")
+    warps = {}
+    for spec in args.warp:
+        label, sep, path = spec.partition("=")
+        if not sep or label not in labels:
+            parser.error(f"--warp expects LABEL=WARP with LABEL in {labels}, got {spec!r}")
+        warps[label] = path
+    if (args.output is None) == (args.tree is None):
+        parser.error("give exactly one of --output or --tree")
+
+    if args.output:
+        n = merge_midis(sources, args.output, warps)
+        print(f"Merged {n} notes from {len(sources)} files into: {args.output}")
+    else:
+        results = merge_tree(args.tree, sources, warps, args.output_name, jobs=args.jobs, force=args.force)
+        failed = [(d, r) for d, r in results if isinstance(r, Exception)]
+        for d, err in failed:
+            print(f"Error merging {d}: {err}")
+        skipped = sum(r is None for _, r in results)
+        print(f"Merged {len(results) - len(failed) - skipped} case folders under {args.tree} "
+              f"({skipped} up to date, {len(failed)} failed).")
+        raise SystemExit(1 if failed else 0)
@@ -0,0 +1,223 @@
+import argparse
+import csv
+import json
+import os
+from pathlib import Path
+import numpy as np
+
+from common import PITCH_STRIDE, find_cases, map_cases
+from notetable import NoteTable
+from warp import TimeWarp
+
+FPS = 25                    # piano-roll frames per second (same as the overlap plots)
+ONSET_MATCH = 0.5           # seconds; farther same-pitch onsets count as unmatched
+ONSET_TOL = 0.05            # seconds; matched onsets closer than this count as "within tolerance"
+HIST_EDGES_MS = np.arange(-100, 105, 5)   # onset-deviation histogram bins (outside = clipped to the ends)
+SEGMENT_SECONDS = 120.0     # per-segment error windows when there is no warp sidecar
+
+# case folder layout written by run_all.py
+TRANSKUN_NAME = "transkun_output.mid"
+ALIGNED_NAME = "aligned_output.mid"
+WARP_NAME = "aligned_output.warp.json"
+
+
+# ========== rasterization / intervals ==========
+def piano_roll(notes, fps=FPS, n_frames=None):
+    """
+    Boolean (n_frames, 128) piano roll: frame k covers [k / fps, (k + 1) / fps) and a note
+    is active from round(start * fps) up to round(end * fps) (at least one frame).
+    Built from +1/-1 boundary counts and one cumulative sum, no per-note loop.
+    """
+    on = np.round(notes.start * fps).astype(np.int64)
+    off = np.maximum(np.round(notes.end * fps).astype(np.int64), on + 1)
+    if n_frames is None:
+        n_frames = int(off.max()) if len(off) else 0
+    on, off = np.clip(on, 0, n_frames), np.clip(off, 0, n_frames)
+    # pitch-major, so the running sum walks contiguous memory; returned as a transposed view
+    row = notes.pitch.astype(np.int64) * (n_frames + 1)
+    size = 128 * (n_frames + 1)
+    delta = (np.bincount(row + on, minlength=size) - np.bincount(row + off, minlength=size)).astype(np.int32)
+    return (np.cumsum(delta.reshape(128, n_frames + 1), axis=1)[:, :-1] > 0).T
+
+def union_length(keys_start, keys_end):
+    """Measure of the union of [start, end) key intervals (keys = pitch * PITCH_STRIDE + time)."""
+    if not len(keys_start):
+        return 0.0
+    times = np.unique(np.concatenate([keys_start, keys_end]))
+    active = np.cumsum(np.bincount(np.searchsorted(times, keys_start), minlength=len(times))
+                       - np.bincount(np.searchsorted(times, keys_end), minlength=len(times)))[:-1]
+    return float(np.diff(times)[active > 0].sum())
+
+def interval_keys(notes, t0=None, t1=None):
+    """Per-pitch note intervals (clipped to [t0, t1]) as pitch-major keys."""
+    start = notes.start if t0 is None else np.maximum(notes.start, t0)
+    end = notes.end if t1 is None else np.minimum(notes.end, t1)
+    keep = end > start
+    offset = notes.pitch[keep].astype(np.float64) * PITCH_STRIDE
+    return offset + start[keep], offset + end[keep]
+
+def prf(tp, n_ref, n_est):
+    precision = tp / n_est if n_est else 0.0
+    recall = tp / n_ref if n_ref else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1}
+
+
+# ========== metrics ==========
+def interval_metrics(ref, est, t0=None, t1=None):
+    """Precision/recall/F1 by sounding time (seconds of per-pitch overlap), no rasterization."""
+    rs, re_ = interval_keys(ref, t0, t1)
+    es, ee = interval_keys(est, t0, t1)
+    n_ref, n_est = union_length(rs, re_), union_length(es, ee)
+    # |A & B| = |A| + |B| - |A | B|
+    tp = max(0.0, n_ref + n_est - union_length(np.concatenate([rs, es]), np.concatenate([re_, ee])))
+    return dict(prf(tp, n_ref, n_est), ref_seconds=n_ref, est_seconds=n_est)
+
+def onset_deviations(ref, est):
+    """
+    Signed deviation (s) of every `est` onset from the nearest `ref` onset of the same pitch
+    (ref - est), NaN where none lies within ONSET_MATCH.
+    """
+    if not len(ref):
+        return np.full(len(est), np.nan)
+    keys = np.sort(ref.pitch.astype(np.float64) * PITCH_STRIDE + ref.start)
+    q = est.pitch.astype(np.float64) * PITCH_STRIDE + est.start
+    j = np.searchsorted(keys, q)
+    right, left = keys[np.minimum(j, len(keys) - 1)] - q, keys[np.maximum(j - 1, 0)] - q
+    dev = np.where(np.abs(right) < np.abs(left), right, left)
+    return np.where(np.abs(dev) <= ONSET_MATCH, dev, np.nan)
+
+def onset_summary(dev):
+    """Matched fraction, |deviation| median / p95 (ms), fraction within ONSET_TOL and histogram."""
+    matched = dev[~np.isnan(dev)]
+    out = {"notes": len(dev), "matched": len(matched) / len(dev) if len(dev) else 0.0,
+           "median_ms": None, "p95_ms": None, "within_tol": 0.0}
+    if len(matched):
+        err = np.abs(matched) * 1000
+        out.update(median_ms=float(np.median(err)), p95_ms=float(np.percentile(err, 95)),
+                   within_tol=float(np.mean(err <= ONSET_TOL * 1000)) * out["matched"])
+    counts, _ = np.histogram(np.clip(matched * 1000, HIST_EDGES_MS[0], HIST_EDGES_MS[-1]), bins=HIST_EDGES_MS)
+    out["histogram"] = {"edges_ms": HIST_EDGES_MS.tolist(), "counts": counts.tolist()}
+    return out
+
+def segment_edges(est, warp=None):
+    """Segment boundaries on the aligned timeline: the warp's anchors, else SEGMENT_SECONDS windows."""
+    end = float(est.end.max(initial=0.0))
+    if warp is not None and len(warp.anchors) > 2:
+        inner = np.sort(warp.anchors[1:-1, 1])
+        return np.concatenate([[0.0], inner[(inner > 0) & (inner < end)], [end]])
+    return np.append(np.arange(0.0, end, SEGMENT_SECONDS), end)
+
+def evaluate(transkun, aligned, fps=FPS, warp=None, mode="frame"):
+    """
+    Compare an aligned GT MIDI with the Transkun MIDI it was aligned to (paths or NoteTables,
+    drums skipped). `mode` "frame" scores piano rolls at `fps`, "interval" exact sounding time.
+    Returns a JSON-ready dict: overall scores, onset deviations and per-segment errors.
+    """
+    ref = transkun if isinstance(transkun, NoteTable) else NoteTable.from_midi(transkun, include_drums=False)
+    est = aligned if isinstance(aligned, NoteTable) else NoteTable.from_midi(aligned, include_drums=False)
+    if warp is not None and not isinstance(warp, TimeWarp):
+        warp = TimeWarp.load(warp)
+    dev = onset_deviations(ref, est)
+
+    if mode == "frame":
+        n = int(max(np.round(ref.end.max(initial=0) * fps), np.round(est.end.max(initial=0) * fps))) + 1
+        ref_roll, est_roll = piano_roll(ref, fps, n), piano_roll(est, fps, n)
+        hit = (ref_roll & est_roll).sum(axis=1)
+        # per-frame counts, so each segment's score is a difference of prefix sums
+        cum = [np.concatenate([[0], np.cumsum(c)]) for c in (hit, ref_roll.sum(axis=1), est_roll.sum(axis=1))]
+
+        def scores(t0, t1):
+            a, b = int(np.clip(np.round(t0 * fps), 0, n)), int(np.clip(np.round(t1 * fps), 0, n))
+            tp, n_ref, n_est = (int(c[b] - c[a]) for c in cum)
+            return dict(prf(tp, n_ref, n_est), ref_frames=n_ref, est_frames=n_est)
+    elif mode == "interval":
+        def scores(t0, t1):
+            return interval_metrics(ref, est, t0, t1)
+    else:
+        raise ValueError(f"mode must be 'frame' or 'interval', got {mode!r}")
+
+    edges = segment_edges(est, warp)
+    overall = scores(-np.inf, np.inf)
+    seg = np.searchsorted(edges, est.start, side="right") - 1
+    segments = []
+    for k in range(len(edges) - 1):
+        t1 = edges[k + 1] + (1.0 / fps if k == len(edges) - 2 else 0.0)
+        s = onset_summary(dev[seg == k])
+        s.pop("histogram")
+        segments.append(dict(start=float(edges[k]), end=float(edges[k + 1]), **scores(edges[k], t1), onset=s))
+    return {"mode": mode, "fps": fps, mode: overall, "onset": onset_summary(dev), "segments": segments}
+
+
+# ========== batch ==========
+def evaluate_case(case_dir, fps=FPS, mode="frame"):
+    case_dir = Path(case_dir)
+    warp = case_dir / WARP_NAME
+    return evaluate(case_dir / TRANSKUN_NAME, case_dir / ALIGNED_NAME, fps=fps,
+                    warp=warp if warp.exists() else None, mode=mode)
+
+def summary_row(case, result):
+    """One flat CSV row per case: overall scores, onset deviation and the worst segment."""
+    overall, onset = result[result["mode"]], result["onset"]
+    worst = max(result["segments"], key=lambda s: s["onset"]["median_ms"] or 0.0, default=None)
+    return {"case": case, "precision": round(overall["precision"], 4), "recall": round(overall["recall"], 4),
+            "f1": round(overall["f1"], 4), "notes": onset["notes"], "onset_matched": round(onset["matched"], 4),
+            "onset_median_ms": onset["median_ms"], "onset_p95_ms": onset["p95_ms"],
+            "onset_within_tol": round(onset["within_tol"], 4), "segments": len(result["segments"]),
+            "worst_segment_start": worst["start"] if worst else None,
+            "worst_segment_median_ms": worst["onset"]["median_ms"] if worst else None}
+
+def evaluate_tree(root, fps=FPS, mode="frame", jobs=1):
+    """
+    evaluate_case for every case folder under `root`, over `jobs` spawn processes.
+    Returns {case folder (relative to root): result dict or {"error": message}}, in folder order.
+    """
+    root = Path(root)
+    return {str(d.relative_to(root)): {"error": str(r)} if isinstance(r, Exception) else r
+            for d, r in map_cases(evaluate_case, find_cases(root, [ALIGNED_NAME, TRANSKUN_NAME]), fps, mode, jobs=jobs)}
+
+def write_summary(results, csv_path=None, json_path=None):
+    if json_path:
+        Path(json_path).write_text(json.dumps(results, indent=1))
+    if csv_path:
+        rows = [summary_row(case, r) for case, r in results.items() if "error" not in r]
+        with open(csv_path, "w", newline="") as f:
+            fields = list(rows[0]) if rows else ["case"]
+            writer = csv.DictWriter(f, fieldnames=fields + ["error"])
+            writer.writeheader()
+            writer.writerows(rows)
+            writer.writerows({"case": case, "error": r["error"]} for case, r in results.items() if "error" in r)
+
+# === CLI entry ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Frame-level / onset alignment metrics of aligned GT vs Transkun MIDI, for one case or a whole batch folder.")
+    parser.add_argument("--transkun", type=str, default=None, help="Transkun MIDI (single case)")
+    parser.add_argument("--aligned", type=str, default=None, help="Aligned GT MIDI (single case)")
+    parser.add_argument("--warp", type=str, default=None, help="Warp sidecar; its anchors define the segments (single case)")
+    parser.add_argument("--tree", type=str, default=None, help=f"Evaluate every folder under this root holding {TRANSKUN_NAME} and {ALIGNED_NAME}")
+    parser.add_argument("--fps", type=int, default=FPS, help=f"Piano-roll frames per second (default: {FPS})")
+    parser.add_argument("--mode", choices=["frame", "interval"], default="frame", help="Piano-roll frames or exact interval overlap (default: frame)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes for --tree (default: all cores)")
+    parser.add_argument("--json", type=str, default=None, help="Write the full results as JSON")
+    parser.add_argument("--csv", type=str, default=None, help="Write one summary row per case as CSV")
+    args = parser.parse_args()
+
+    if (args.tree is None) == (args.transkun is None or args.aligned is None):
+        parser.error("give either --tree or both --transkun and --aligned")
+    if args.tree:
+        results = evaluate_tree(args.tree, fps=args.fps, mode=args.mode, jobs=args.jobs)
+    else:
+        results = {Path(args.aligned).parent.name or ".": evaluate(args.transkun, args.aligned, fps=args.fps, warp=args.warp, mode=args.mode)}
+    write_summary(results, args.csv, args.json)
+
+    for case, r in results.items():
+        if "error" in r:
+            print(f"{case}: error: {r['error']}")
+            continue
+        row = summary_row(case, r)
+        median = "-" if row["onset_median_ms"] is None else f"{row['onset_median_ms']:.1f}"
+        print(f"{case}: P {row['precision']:.3f}  R {row['recall']:.3f}  F1 {row['f1']:.3f}  "
+              f"onset median {median} ms, {row['onset_within_tol']:.1%} within {ONSET_TOL * 1000:.0f} ms "
+              f"({row['segments']} segments)")
+    for path in filter(None, [args.json, args.csv]):
+        print(f"Saved: {path}")
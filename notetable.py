@@ -0,0 +1,170 @@
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+import pretty_midi
+
+# parsed-note cache: `<file>.mid.notes.npz` next to each MIDI file, reused while the file's
+# size and mtime match (or, if it was touched, while its sha256 matches)
+CACHE_NOTES = True
+CACHE_SUFFIX = ".notes.npz"
+CACHE_VERSION = 1
+
+
+class NoteTable:
+    """
+    Notes of a MIDI file as contiguous columns, sorted by onset (stable, so notes
+    with equal onsets keep their file order):
+      start, end : float64 seconds
+      pitch, velocity : int16
+      instrument : int16 index into the source's instruments
+      drum       : bool, note comes from a drum track
+      order      : int64 position of the note in file order (instrument by instrument)
+    """
+    COLUMNS = ("start", "end", "pitch", "velocity", "instrument", "drum", "order")
+
+    def __init__(self, start, end, pitch, velocity=None, instrument=None, drum=None, order=None):
+        n = len(start)
+        self.start = np.asarray(start, dtype=np.float64)
+        self.end = np.asarray(end, dtype=np.float64)
+        self.pitch = np.asarray(pitch, dtype=np.int16)
+        self.velocity = np.full(n, 100, np.int16) if velocity is None else np.asarray(velocity, dtype=np.int16)
+        self.instrument = np.zeros(n, np.int16) if instrument is None else np.asarray(instrument, dtype=np.int16)
+        self.drum = np.zeros(n, bool) if drum is None else np.asarray(drum, dtype=bool)
+        self.order = np.arange(n, dtype=np.int64) if order is None else np.asarray(order, dtype=np.int64)
+
+    # ---------- construction ----------
+    @classmethod
+    def _sorted(cls, cols):
+        idx = np.argsort(np.asarray(cols[0], dtype=np.float64), kind="stable")
+        return cls(*(np.asarray(c)[idx] for c in cols))
+
+    @classmethod
+    def from_midi(cls, source, include_drums=True, cache=None):
+        """
+        Load a MIDI path or PrettyMIDI object once into onset-sorted columns. Paths go
+        through the parsed-note cache (see `load_cached`) unless `cache` is False
+        (default: CACHE_NOTES at call time).
+        """
+        cache = CACHE_NOTES if cache is None else cache
+        if not isinstance(source, pretty_midi.PrettyMIDI) and cache:
+            table = load_cached(source)
+            return table if include_drums else table.without_drums()
+        midi = source if isinstance(source, pretty_midi.PrettyMIDI) else pretty_midi.PrettyMIDI(str(source))
+        cols = [[] for _ in range(6)]
+        for i, inst in enumerate(midi.instruments):
+            if inst.is_drum and not include_drums:
+                continue
+            for n in inst.notes:
+                cols[0].append(n.start)
+                cols[1].append(n.end)
+                cols[2].append(n.pitch)
+                cols[3].append(n.velocity)
+                cols[4].append(i)
+                cols[5].append(inst.is_drum)
+        return cls._sorted(cols + [np.arange(len(cols[0]))])
+
+    @classmethod
+    def from_notes(cls, notes):
+        """From (start, end, pitch) rows: a list of tuples or an (N, 3) array."""
+        arr = np.asarray(notes, dtype=np.float64).reshape(-1, 3)
+        return cls._sorted([arr[:, 0], arr[:, 1], arr[:, 2].astype(np.int16),
+                            np.full(len(arr), 100), np.zeros(len(arr)), np.zeros(len(arr), bool),
+                            np.arange(len(arr))])
+
+    def take(self, idx):
+        """Sub-table of rows `idx` (a slice, index array or boolean mask)."""
+        return NoteTable(*(getattr(self, c)[idx] for c in self.COLUMNS))
+
+    # ---------- views ----------
+    def __len__(self):
+        return len(self.start)
+
+    def without_drums(self):
+        return self if not self.drum.any() else self.take(~self.drum)
+
+    def slice_time(self, t0=None, t1=None, mode="onset"):
+        """
+        Notes in [t0, t1] (None = open end).
+          mode="onset":   t0 <= start <= t1 (two binary searches, returns a view)
+          mode="overlap": start <= t1 and end >= t0 (note sounds somewhere in the window)
+        """
+        if mode == "onset":
+            lo = 0 if t0 is None else np.searchsorted(self.start, t0, side="left")
+            hi = len(self) if t1 is None else np.searchsorted(self.start, t1, side="right")
+            return self.take(slice(lo, hi))
+        if mode != "overlap":
+            raise ValueError(f"mode must be 'onset' or 'overlap', got {mode!r}")
+        if t0 is None and t1 is None:
+            return self
+        hi = len(self) if t1 is None else np.searchsorted(self.start, t1, side="right")
+        keep = np.ones(hi, bool) if t0 is None else self.end[:hi] >= t0
+        return self.take(np.flatnonzero(keep))
+
+    def by_pitch(self):
+        """{pitch: (start, end)} arrays per pitch, each still sorted by onset."""
+        idx = np.argsort(self.pitch, kind="stable")
+        pitches, first = np.unique(self.pitch[idx], return_index=True)
+        groups = np.split(idx, first[1:])
+        return {int(p): (self.start[g], self.end[g]) for p, g in zip(pitches, groups)}
+
+    def tuples(self):
+        """(start, end, pitch) tuples in onset order."""
+        return list(zip(self.start.tolist(), self.end.tolist(), self.pitch.tolist()))
+
+
+# ========== parsed-note cache ==========
+def cache_path(midi_path):
+    return Path(str(midi_path) + CACHE_SUFFIX)
+
+def _sha256(path):
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+def _read_cache(cpath, midi_path, st):
+    """Cached table if `cpath` belongs to the current contents of `midi_path`, plus whether its key is stale."""
+    try:
+        with np.load(cpath) as data:
+            version, size, mtime_ns = data["meta"].tolist()
+            if version != CACHE_VERSION:
+                return None, False
+            stale = (size, mtime_ns) != (st.st_size, st.st_mtime_ns)
+            if stale and str(data["sha256"]) != _sha256(midi_path):
+                return None, False
+            return NoteTable(*(data[c] for c in NoteTable.COLUMNS)), stale
+    except (OSError, KeyError, ValueError):
+        return None, False
+
+def _write_cache(cpath, midi_path, st, table):
+    """Write-then-rename; an unwritable folder just means no cache."""
+    tmp = cpath.with_name(f"{cpath.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            np.savez(f, meta=np.array([CACHE_VERSION, st.st_size, st.st_mtime_ns], dtype=np.int64),
+                     sha256=np.array(_sha256(midi_path)), **{c: getattr(table, c) for c in NoteTable.COLUMNS})
+        os.replace(tmp, cpath)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+
+def load_cached(midi_path):
+    """
+    All notes (drums included) of a MIDI file from its `.notes.npz` sidecar, parsing with
+    pretty_midi and (re)writing the sidecar only when it is missing or out of date.
+    """
+    midi_path = Path(midi_path)
+    st = midi_path.stat()
+    cpath = cache_path(midi_path)
+    table, stale = _read_cache(cpath, midi_path, st)
+    if table is None:
+        table = NoteTable.from_midi(pretty_midi.PrettyMIDI(str(midi_path)))
+        stale = True
+    if stale:
+        _write_cache(cpath, midi_path, st, table)
+    return table
+
+def load_notes(source, include_drums=True):
+    """NoteTable for a MIDI path, PrettyMIDI object, NoteTable or (start, end, pitch) rows."""
+    if isinstance(source, NoteTable):
+        return source if include_drums else source.without_drums()
+    if isinstance(source, (str, Path, pretty_midi.PrettyMIDI)):
+        return NoteTable.from_midi(source, include_drums)
+    return NoteTable.from_notes(source)
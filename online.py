@@ -0,0 +1,241 @@
+import argparse
+import logging
+import sys
+import time
+import numpy as np
+import pretty_midi
+
+import correction
+from correction import (AlignmentResult, OnsetIndex, build_mappings, clamp,
+                        find_first_anchor_original, find_last_anchor_original,
+                        find_segment_anchor_coarse_to_fine,
+                        find_segment_anchor_sequence_expected, log,
+                        segment_gt_timeline)
+from notetable import NoteTable, load_notes
+from warp import TimeWarp
+
+# search attempts that may simply be premature go here instead of the main log
+_quiet = logging.getLogger("correction.online.search")
+_quiet.addHandler(logging.NullHandler())
+_quiet.propagate = False
+
+
+class OnlineAligner:
+    """
+    GT -> Transkun alignment while the Transkun output is still growing.
+
+    Transkun notes arrive in chunks (`feed`). Anchors are committed as soon as the part of
+    the transcription their search reads is settled (no later chunk can change it):
+      - first anchor: the offline search restricted to settled onsets; once one of the
+        first GT groups matched, later data cannot produce an earlier match
+      - middle anchors: the offline bi-sliding sequence search, but centered on the drift
+        extrapolated from the anchors committed so far (last two anchors, or the first
+        anchor's offset) instead of on the last anchor, which does not exist yet; on a
+        miss, the coarse-to-fine search over the settled transcription, retried per chunk
+      - last anchor: the offline search, in `finish()`
+    Every committed anchor closes the previous segment; its GT notes are returned warped.
+    A GT note is therefore emitted at most `max_latency` seconds of transcription after its
+    segment starts (segment length + search window + sequence span); `segment_seconds` trades
+    latency against the number of anchors.
+    """
+
+    def __init__(self, gt, epsilon=0.01, segment_seconds=None, logger=log, verbose_search=False):
+        self.epsilon = epsilon
+        self.logger = logger
+        self.search_logger = logger if verbose_search else _quiet
+        self.gt_notes = load_notes(gt)                      # emitted notes (drums included)
+        self.gt_index = OnsetIndex(self.gt_notes.without_drums(), epsilon)
+        self.segment_seconds = segment_seconds or correction.segment_minutes * 60.0
+
+        self.segments = segment_gt_timeline(self.gt_index.onsets[-1], logger, self.segment_seconds)
+        self.tr_index = None
+        self.until = float("-inf")
+        self.anchors = []
+        self.mappings = []
+        self.window_missed = False
+        self.finished = False
+        self._emitted = np.zeros(len(self.gt_notes), bool)
+        self.timings = {"search": 0.0}
+
+    @property
+    def max_latency(self):
+        """
+        Upper bound (s) between a segment's start in the transcription and its notes being
+        emitted, when the expected window finds the next anchor (coarse-to-fine waits for data).
+        """
+        return self.segment_seconds + correction.max_fwd + correction.seq_max_span + self.epsilon
+
+    # ---------- input ----------
+    def feed(self, notes, until=None):
+        """
+        Add a chunk of Transkun notes; `until` is the time up to which the transcription is
+        complete (default: the last onset received). Returns the newly aligned GT notes.
+        """
+        chunk = load_notes(notes)
+        if len(chunk):
+            # only the tail from the chunk's first onset on is rebuilt, so a session stays linear
+            if self.tr_index is None:
+                self.tr_index = OnsetIndex(chunk, self.epsilon)
+            else:
+                self.tr_index.extend(chunk)
+        if until is None:
+            until = float(chunk.start.max()) if len(chunk) else self.until
+        self.until = max(self.until, until)
+        return self._advance()
+
+    def finish(self):
+        """End of the transcription: find the last anchor and return all remaining GT notes."""
+        if self.finished:
+            return self.gt_notes.take(slice(0, 0))
+        self.until = float("inf")
+        self._advance()
+        if self.tr_index is None or not self.anchors:
+            raise RuntimeError("Failed to find matching first anchor in Transkun MIDI.")
+        if len(self.anchors) < len(self.segments):
+            raise RuntimeError(f"Failed to find anchor for segment starting at {self.segments[len(self.anchors)][0]:.3f}s")
+
+        t0 = time.perf_counter()
+        self.logger.info("\n===== [Final] GT Last Anchor =====")
+        self.anchors.append(find_last_anchor_original(self.gt_index, self.tr_index, self.anchors[0][2], logger=self.logger))
+        self.timings["search"] += time.perf_counter() - t0
+        self.finished = True
+        return self._commit(final=True)
+
+    def result(self):
+        """AlignmentResult of the finished stream (same layout as correction.align)."""
+        if not self.finished:
+            raise RuntimeError("OnlineAligner.result() needs finish() first")
+        return AlignmentResult(epsilon=self.epsilon, anchors=list(self.anchors),
+                               mappings=list(self.mappings), timings=dict(self.timings))
+
+    # ---------- anchor commits ----------
+    def _advance(self):
+        if self.tr_index is None or self.finished:
+            return self.gt_notes.take(slice(0, 0))
+        settled = self.until - self.epsilon      # every onset group up to here is complete
+        t0 = time.perf_counter()
+        committed = False
+        if not self.anchors:
+            try:
+                first = find_first_anchor_original(self.gt_index, self.tr_index, correction.n_attempts,
+                                                   logger=self.search_logger, until=settled)
+            except RuntimeError:
+                first = None
+            if first is not None:
+                self.anchors.append(first)
+                committed = True
+                self.logger.info(f"[Online] First anchor: GT {first[0]:.3f}s -> TR {first[2]:.3f}s")
+        while self.anchors and len(self.anchors) < len(self.segments):
+            anchor = self._next_middle_anchor(settled)
+            if anchor is None:
+                break
+            self.anchors.append(anchor)
+            committed = True
+        self.timings["search"] += time.perf_counter() - t0
+        return self._commit() if committed else self.gt_notes.take(slice(0, 0))
+
+    def _expected(self, seg_start):
+        """Expected Transkun time of `seg_start` and the drift since the last anchor."""
+        gt1, _, tr1, *_ = self.anchors[-1]
+        slope = 1.0
+        if len(self.anchors) >= 2:
+            gt0, _, tr0, *_ = self.anchors[-2]
+            if abs(gt1 - gt0) >= correction.min_denom:
+                slope = (tr1 - tr0) / (gt1 - gt0)
+        return tr1 + slope * (seg_start - gt1), (slope - 1.0) * (seg_start - gt1)
+
+    def _next_middle_anchor(self, settled):
+        seg_start, seg_end = self.segments[len(self.anchors)]
+        prev_trans_time = self.anchors[-1][2]
+        center, drift = self._expected(seg_start)
+        upper_bound = self._expected(seg_end)[0] + correction.max_fwd
+        back = clamp(correction.min_back, correction.scale_back * abs(drift), correction.max_back)
+        fwd = clamp(correction.min_fwd, correction.scale_fwd * abs(drift), correction.max_fwd)
+        anchor = None
+        if correction.anchor_search == "window" and not self.window_missed:
+            # the search reads candidate sequences up to seq_max_span (+ one group) past the window
+            if center + fwd + correction.seq_max_span + self.epsilon > settled:
+                return None
+            anchor = find_segment_anchor_sequence_expected(
+                self.gt_index, self.tr_index, seg_start_gt_time=seg_start,
+                center=center, back=back, fwd=fwd,
+                prev_trans_time=prev_trans_time, logger=self.search_logger,
+            )
+            if anchor is None:
+                self.logger.info(f"[Online] No match for segment @ {seg_start:.3f}s in expected window; "
+                                 "coarse-to-fine search as the transcription grows.")
+                self.window_missed = True
+        if anchor is None:
+            # coarse signatures and refine windows (whose forward lead over the first GT groups
+            # stays well under coarse_span) must lie in the settled part
+            until = settled - correction.coarse_refine - correction.coarse_span - correction.seq_max_span - self.epsilon
+            anchor = find_segment_anchor_coarse_to_fine(
+                self.gt_index, self.tr_index, seg_start_gt_time=seg_start,
+                prev_trans_time=prev_trans_time, logger=self.search_logger,
+                until=None if until == float("inf") else until,
+                center=center, upper_bound=upper_bound,
+            )
+            if anchor is None:
+                if settled == float("inf"):
+                    raise RuntimeError(f"Failed to find anchor for segment starting at {seg_start:.3f}s")
+                return None
+        self.window_missed = False
+        self.logger.info(f"[Online] Anchor for segment @ {seg_start:.3f}s: GT {anchor[0]:.3f}s -> TR {anchor[2]:.3f}s "
+                         f"(expected {center:.3f}, window -{back:.2f}/+{fwd:.2f})")
+        return anchor
+
+    def _commit(self, final=False):
+        """Rebuild the mappings of all closed segments and return the GT notes they newly cover."""
+        closed = self.segments[:len(self.anchors) - 1]
+        self.mappings = build_mappings(self.anchors, closed, logger=self.logger if final else _quiet)
+        warp = TimeWarp(self.mappings, self.epsilon)
+        k = warp.segment_of(self.gt_notes.start)
+        new = ~self._emitted & ((k >= 0) | final)   # later notes wait for their segment to close
+        self._emitted |= new
+        out = warp.apply_notes(self.gt_notes.take(new), extrapolate=False)   # as apply_alignment
+        if len(out):
+            horizon = "end of stream" if final else f"TR horizon {self.until:.3f}s"
+            self.logger.info(f"[Online] Emitted {len(out)} GT notes up to {float(out.start.max()):.3f}s ({horizon})")
+        return out
+
+
+def align_streaming(gt, transkun, chunk_seconds=10.0, epsilon=0.01, segment_seconds=None, logger=log):
+    """
+    Replay a complete Transkun output through OnlineAligner in `chunk_seconds` pieces
+    (for testing the online mode). Returns (result, [(horizon, emitted NoteTable), ...]).
+    """
+    tr = load_notes(transkun, include_drums=False)
+    aligner = OnlineAligner(gt, epsilon=epsilon, segment_seconds=segment_seconds, logger=logger)
+    emitted = []
+    end = float(tr.start.max()) if len(tr) else 0.0
+    for t in np.arange(chunk_seconds, end + chunk_seconds, chunk_seconds).tolist():
+        # notes with onsets in [t - chunk, t): the transcription is complete up to t
+        chunk = tr.slice_time(t - chunk_seconds, t)
+        chunk = chunk.take(chunk.start < t)
+        emitted.append((t, aligner.feed(chunk, until=t)))
+    emitted.append((float("inf"), aligner.finish()))
+    return aligner.result(), emitted
+
+# ==== CLI ====
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Online GT -> Transkun alignment, replaying a Transkun MIDI in time chunks.")
+    parser.add_argument("--gt", type=str, required=True, help="Path to original GT MIDI file")
+    parser.add_argument("--transkun", type=str, required=True, help="Path to (growing) transkun MIDI file")
+    parser.add_argument("--output", type=str, required=True, help="Path to save aligned GT MIDI")
+    parser.add_argument("--chunk", type=float, default=10.0, help="Seconds of transcription per chunk (default: 10)")
+    parser.add_argument("--segment-seconds", type=float, default=None, help="Segment length; bounds the emission latency (default: segment_minutes)")
+    parser.add_argument("--epsilon", type=float, default=0.01, help="Time tolerance for grouping (default: 0.01s)")
+    parser.add_argument("--warp", type=str, default=None, help="Also save the time warp sidecar here (.json or .npz)")
+    parser.add_argument("--quiet", action="store_true", help="Only log warnings and errors")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s", stream=sys.stdout)
+
+    gt_midi = pretty_midi.PrettyMIDI(args.gt)
+    result, emitted = align_streaming(NoteTable.from_midi(gt_midi), args.transkun, chunk_seconds=args.chunk,
+                                      epsilon=args.epsilon, segment_seconds=args.segment_seconds)
+    correction.apply_alignment(gt_midi, result)
+    gt_midi.write(args.output)
+    log.info(f"\nSaved aligned GT MIDI to: {args.output}")
+    if args.warp:
+        result.warp.save(args.warp)
+        log.info(f"Saved time warp to: {args.warp}")
@@ -1,43 +1,52 @@
 import argparse
-import pretty_midi
 import matplotlib.pyplot as plt
 import numpy as np
-from collections import defaultdict
+from matplotlib.collections import LineCollection
 from matplotlib.lines import Line2D
 from pathlib import Path
-
-def filter_notes(notes, start, end):
-    if start is None and end is None:
-        return notes
-    return [n for n in notes if (end is None or n[0] <= end) and (start is None or n[1] >= start)]
-
-def has_overlap(s1, e1, s2, e2, tol):
-    return max(0, min(e1, e2) - max(s1, s2)) > tol
+from notetable import NoteTable
+
+def coverage(intervals, times):
+    """
+    Sweep over the sorted boundary `times`: +1 where an interval starts, -1 where it
+    ends, running sum = number of intervals active on [times[i], times[i+1]].
+    Empty or reversed intervals never cover a segment and are skipped.
+    """
+    iv = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    iv = iv[iv[:, 0] < iv[:, 1]]
+    n = len(times)
+    delta = (np.bincount(np.searchsorted(times, iv[:, 0]), minlength=n)
+             - np.bincount(np.searchsorted(times, iv[:, 1]), minlength=n))
+    return np.cumsum(delta)[:-1]
 
 def split_segments(intervals_a, intervals_b, color_a, color_b, overlap_color, tol):
+    """
+    Cut the union of both interval lists at every boundary and color each elementary
+    segment by whether A, B or both overlap it by more than `tol`. An interval either
+    covers a whole elementary segment (overlap = segment length) or touches it with
+    overlap <= 0, so one sweep with active counters decides all segments at once.
+    """
     all_times = []
     for s, e in intervals_a + intervals_b:
         all_times.extend([s, e])
     all_times = sorted(set(all_times))
-
-    segments = []
-    for i in range(len(all_times) - 1):
-        seg_start = all_times[i]
-        seg_end = all_times[i + 1]
-
-        in_a = any(has_overlap(seg_start, seg_end, s, e, tol) for s, e in intervals_a)
-        in_b = any(has_overlap(seg_start, seg_end, s, e, tol) for s, e in intervals_b)
-
-        if in_a and in_b:
-            color = overlap_color
-        elif in_a:
-            color = color_a
-        elif in_b:
-            color = color_b
-        else:
-            continue
-        segments.append((seg_start, seg_end, color))
-    return segments
+    if len(all_times) < 2:
+        return []
+
+    times = np.asarray(all_times, dtype=np.float64)
+    if tol < 0:
+        # max(0, overlap) > tol holds for every interval
+        in_a = np.full(len(times) - 1, bool(intervals_a))
+        in_b = np.full(len(times) - 1, bool(intervals_b))
+    else:
+        long_enough = (times[1:] - times[:-1]) > tol
+        in_a = (coverage(intervals_a, times) > 0) & long_enough
+        in_b = (coverage(intervals_b, times) > 0) & long_enough
+
+    colors = np.where(in_a & in_b, 2, np.where(in_a, 0, np.where(in_b, 1, -1)))
+    palette = (color_a, color_b, overlap_color)
+    return [(all_times[i], all_times[i + 1], palette[c])
+            for i, c in enumerate(colors.tolist()) if c >= 0]
 
 def time2x(t, display_mode, fps):
     return t if display_mode == 'time' else t * fps
@@ -46,24 +55,18 @@ def label_xaxis(display_mode, fps):
     return "time (s)" if display_mode == 'time' else f"frame index (fps={fps})"
 
 def plot_overlap(transkun_path, aligned_path, output_path, start_time, end_time, tolerance, display_mode, fps):
-    transkun_midi = pretty_midi.PrettyMIDI(str(transkun_path))
-    aligned_midi = pretty_midi.PrettyMIDI(str(aligned_path))
-
-    gt_notes = [(n.start, n.end, n.pitch) for inst in transkun_midi.instruments for n in inst.notes]
-    pred_notes = [(n.start, n.end, n.pitch) for inst in aligned_midi.instruments for n in inst.notes]
-
-    gt_notes = filter_notes(gt_notes, start_time, end_time)
-    pred_notes = filter_notes(pred_notes, start_time, end_time)
+    # one columnar load per file; notes sounding anywhere in the window, grouped by pitch
+    gt_notes = NoteTable.from_midi(transkun_path).slice_time(start_time, end_time, mode="overlap")
+    pred_notes = NoteTable.from_midi(aligned_path).slice_time(start_time, end_time, mode="overlap")
 
-    gt_by_pitch = defaultdict(list)
-    pred_by_pitch = defaultdict(list)
-    for s, e, p in gt_notes:
-        gt_by_pitch[p].append((s, e))
-    for s, e, p in pred_notes:
-        pred_by_pitch[p].append((s, e))
+    gt_by_pitch = {p: list(zip(s.tolist(), e.tolist())) for p, (s, e) in gt_notes.by_pitch().items()}
+    pred_by_pitch = {p: list(zip(s.tolist(), e.tolist())) for p, (s, e) in pred_notes.by_pitch().items()}
 
     plt.figure(figsize=(12, 6))
+    ax = plt.gca()
 
+    # gather every colored segment, then draw them all as one LineCollection
+    seg_times, seg_pitches, seg_colors = [], [], []
     all_pitches = sorted(set(gt_by_pitch.keys()).union(pred_by_pitch.keys()))
     for pitch in all_pitches:
         gt_intervals = gt_by_pitch.get(pitch, [])
@@ -78,7 +81,16 @@ def plot_overlap(transkun_path, aligned_path, output_path, start_time, end_time,
                 continue
             if end_time and s > end_time:
                 continue
-            plt.plot([time2x(s, display_mode, fps), time2x(e, display_mode, fps)], [pitch, pitch], color=color, linewidth=2)
+            seg_times.append((s, e))
+            seg_pitches.append(pitch)
+            seg_colors.append(color)
+
+    if seg_times:
+        x = time2x(np.asarray(seg_times, dtype=np.float64), display_mode, fps)   # (n, 2)
+        y = np.repeat(np.asarray(seg_pitches, dtype=np.float64)[:, None], 2, axis=1)
+        lines = np.stack([x, y], axis=-1)                                       # (n, 2 points, xy)
+        ax.add_collection(LineCollection(lines, colors=seg_colors, linewidths=2, capstyle="projecting"))
+        ax.autoscale_view()
 
     plt.xlabel(label_xaxis(display_mode, fps))
     plt.ylabel("MIDI pitch")
@@ -1,87 +1,387 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
 import os
+import resource
 import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
+import numpy as np
+import pretty_midi
 from tqdm import tqdm
 
+import matplotlib
+matplotlib.use("Agg")
+
+import common
+import correction
+import notetable
+import overlap
+import stage_cache
+import toaudio
+import warp
+
 # Paths
 BASE_DIR = Path("/storage/user/ljia/folder_for_share")
 SOURCE_DIR = BASE_DIR / "2025-07-18"
+VIDEO_NAME = "cam00045D6F85000.mp4"
 TRANSTOOL = "transkun"
 FPS = 25
 
-# Scripts (assumed in same folder or full path)
-CORRECTION = "correction.py"
-TOAUDIO = "toaudio.py"
-OVERLAP = "overlap.py"
-
-# Collect cases
-subfolders = sorted([d for d in SOURCE_DIR.iterdir() if d.is_dir()])
-total_cases = len(subfolders)
-print(f"Found {total_cases} cases.")
-
-# Process with tqdm progress bar
-for idx, subdir in enumerate(tqdm(subfolders, desc="Processing Cases"), start=1):
-    case_dir = BASE_DIR / f"case{idx}"
-    case_dir.mkdir(exist_ok=True)
-    
-    video_path = subdir / "cam00045D6F85000.mp4"
-    gt_midi_path = subdir / f"{subdir.name}.mid"
-    extracted_mp3 = case_dir / "audio.mp3"
-    transkun_midi = case_dir / "transkun_output.mid"
-    aligned_midi = case_dir / "aligned_output.mid"
-    audio_output_wav = case_dir / "aligned_output.wav"
-    new_mp4_path = case_dir / "output_aligned.mp4"
-    overlap_png = case_dir / "overlap.png"
+# Audio handed to transkun by the extract step:
+#   "wav"  = mono 16-bit PCM already at TRANSKUN_RATE (no lossy encode, no decode/resample in transkun)
+#   "pipe" = the same PCM in a temporary file written and removed by the transkun step, no audio file kept
+#   "mp3"  = the old VBR mp3
+AUDIO_FORMAT = "wav"
+TRANSKUN_RATE = 44100       # sample rate of transkun's model
+AUDIO_RANGE = None          # (start, end) seconds of the video to transcribe, None = all of it
+MP3_ARGS = ["-q:a", "0", "-map", "a"]
+PCM_ARGS = ["-map", "a:0", "-ac", "1", "-ar", str(TRANSKUN_RATE), "-c:a", "pcm_s16le", "-f", "wav"]
+AUDIO_FILES = {"wav": "audio.wav", "mp3": "audio.mp3", "pipe": None}
+
+# Overlap plot settings
+OVERLAP_START = 70
+OVERLAP_END = 80
+OVERLAP_TOLERANCE = 0.01
+OVERLAP_MODE = "time"
+
+
+# ========== stages ==========
+def case_paths(idx, subdir, base_dir, keep_wav=False, audio_format=AUDIO_FORMAT, audio_range=AUDIO_RANGE):
+    """All input/output paths of one case; optional artifacts are None when disabled."""
+    case_dir = base_dir / f"case{idx}"
+    audio_name = AUDIO_FILES[audio_format]
+    return {
+        "name": f"case{idx}: {subdir.name}",
+        "case_dir": case_dir,
+        "video": subdir / VIDEO_NAME,
+        "gt_midi": subdir / f"{subdir.name}.mid",
+        "audio": case_dir / audio_name if audio_name else None,
+        "audio_format": audio_format,
+        "audio_range": tuple(audio_range) if audio_range else None,
+        "transkun_midi": case_dir / "transkun_output.mid",
+        "aligned_midi": case_dir / "aligned_output.mid",
+        "warp": case_dir / "aligned_output.warp.json",
+        "wav": case_dir / "aligned_output.wav" if keep_wav else None,
+        "mp4": case_dir / "output_aligned.mp4",
+        "overlap_png": case_dir / "overlap.png",
+    }
+
+def run_quiet(cmd):
+    """Run `cmd` silently; returns the child's own CPU seconds and peak RSS (wait4 rusage)."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return {"cpu_s": usage.ru_utime + usage.ru_stime, "max_rss_mb": usage.ru_maxrss / 1024}
+
+def extract_command(c, output):
+    """ffmpeg command writing the case's audio (format and time range from `c`) to `output`."""
+    seek = []
+    if c["audio_range"]:
+        start, end = c["audio_range"]
+        # input options: ffmpeg seeks in the container and decodes only the requested span
+        seek = ["-ss", f"{start:g}", "-t", f"{end - start:g}"]
+    args = MP3_ARGS if c["audio_format"] == "mp3" else PCM_ARGS
+    return ["ffmpeg", "-y", "-nostdin"] + seek + ["-i", str(c["video"])] + args + [str(output)]
+
+def shift_midi(midi_path, offset):
+    """Move every event of a MIDI file `offset` seconds later (back onto the video timeline)."""
+    midi = pretty_midi.PrettyMIDI(str(midi_path))
+    warp.TimeWarp([[0.0, np.inf, 1.0, offset]], 0.0).apply_midi(midi)
+    midi.write(str(midi_path))
+
+def stage_extract(c):
+    # Step 1: Extract audio (nothing to do when the transkun step writes its own temporary copy)
+    c["case_dir"].mkdir(parents=True, exist_ok=True)
+    if c["audio"] is None:
+        return {}
+    return run_quiet(extract_command(c, c["audio"]))
+
+def stage_transkun(c):
+    # Step 2: Run transkun
+    if c["audio"] is None:
+        # transkun reads audio with pydub, which probes a non-.wav path with ffprobe first and
+        # seeks in a .wav, so a pipe or FIFO loses data: use a temporary .wav, removed afterwards
+        with tempfile.TemporaryDirectory(dir=c["case_dir"]) as tmp:
+            wav = Path(tmp) / "audio.wav"
+            extract = run_quiet(extract_command(c, wav))
+            usage = run_quiet([TRANSTOOL, str(wav), str(c["transkun_midi"])])
+        usage = {"cpu_s": extract["cpu_s"] + usage["cpu_s"], "max_rss_mb": max(extract["max_rss_mb"], usage["max_rss_mb"])}
+    else:
+        usage = run_quiet([TRANSTOOL, str(c["audio"]), str(c["transkun_midi"])])
+    if c["audio_range"] and c["audio_range"][0]:
+        shift_midi(c["transkun_midi"], c["audio_range"][0])
+    return usage
+
+def stage_align(c):
+    # Step 3: Align (in-process, no interpreter / pretty_midi start-up per case)
+    result = correction.align_gt_to_transkun(c["gt_midi"], c["transkun_midi"], c["aligned_midi"], warp_path=c["warp"])
+    return {"align": {"timings": result.timings, "stats": result.stats}}
+
+def stage_render_mux(c):
+    # Steps 4+5: Synthesize audio and pipe it into the video's audio track (WAV only as debug copy)
+    toaudio.midi_to_video(c["aligned_midi"], c["video"], c["mp4"], wav_path=c["wav"])
+
+def stage_overlap(c):
+    # Step 6: Generate overlap visualization
+    overlap.plot_overlap(c["transkun_midi"], c["aligned_midi"], c["overlap_png"],
+                         start_time=OVERLAP_START, end_time=OVERLAP_END,
+                         tolerance=OVERLAP_TOLERANCE, display_mode=OVERLAP_MODE, fps=FPS)
+
+# name, function, pool kind, inputs, outputs. Subprocess stages only wait on their
+# child, so they run on threads; Python-heavy stages get their own processes.
+STAGES = [
+    ("extract",  stage_extract,    "thread",  ["video"],                          ["audio"]),
+    ("transkun", stage_transkun,   "thread",  ["audio", "video"],                 ["transkun_midi"]),
+    ("align",    stage_align,      "process", ["gt_midi", "transkun_midi"],       ["aligned_midi", "warp"]),
+    ("render",   stage_render_mux, "process", ["video", "aligned_midi"],          ["mp4", "wav"]),
+    ("overlap",  stage_overlap,    "process", ["transkun_midi", "aligned_midi"],  ["overlap_png"]),
+]
+
+def default_stage_jobs(jobs):
+    """Per-stage pool sizes for `jobs` cores; transkun is CPU-heavy and multi-threaded itself."""
+    share = max(1, jobs // 4)
+    return {"extract": share, "transkun": max(1, jobs // 8), "align": share,
+            "render": share, "overlap": share}
+
+def source_digest(*modules):
+    h = hashlib.sha256()
+    for module in modules:
+        h.update(Path(module.__file__).read_bytes())
+    return h.hexdigest()
+
+# Everything besides input files that changes a stage's outputs; in-process stages
+# also key on their module source so code changes invalidate old artifacts.
+STAGE_PARAMS = {
+    "extract":  {},
+    "transkun": {"tool": TRANSTOOL},
+    "align":    {"config": correction.config(), "code": source_digest(correction, common, notetable, warp)},
+    "render":   {"fs": toaudio.SAMPLE_RATE, "code": source_digest(toaudio)},
+    "overlap":  {"start": OVERLAP_START, "end": OVERLAP_END, "tolerance": OVERLAP_TOLERANCE,
+                 "display_mode": OVERLAP_MODE, "fps": FPS, "code": source_digest(overlap, notetable)},
+}
+
+def stage_params(c, name):
+    """STAGE_PARAMS of a stage; the audio steps also key on the case's audio format, range and ffmpeg options."""
+    params = STAGE_PARAMS[name]
+    if name in ("extract", "transkun"):
+        params = dict(params, audio=c["audio_format"], range=c["audio_range"],
+                      ffmpeg=MP3_ARGS if c["audio_format"] == "mp3" else PCM_ARGS)
+    return params
+
+def stage_files(c, k):
+    name, _, _, inputs, outputs = STAGES[k]
+    return name, [c[i] for i in inputs if c[i] is not None], [c[o] for o in outputs if c[o] is not None]
 
+def is_cached(c, k):
+    """Cheap check from the scheduler: key and outputs match using memoized digests only."""
+    name, inputs, outputs = stage_files(c, k)
+    manifest = stage_cache.Manifest(c["case_dir"])
+    key = manifest.stage_key(name, inputs, stage_params(c, name), compute=False)
+    return manifest.is_current(name, key, outputs, compute=False)
+
+def process_usage():
+    """(CPU seconds, own peak RSS MB, children's peak RSS MB) of this process and its waited-for children."""
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    return cpu, own.ru_maxrss / 1024, children.ru_maxrss / 1024
+
+def reset_peak_rss():
+    """Reset this process' peak RSS (Linux: VmHWM via /proc/self/clear_refs). False if unsupported."""
     try:
-        # Step 1: Extract audio
-        subprocess.run([
-            "ffmpeg", "-y", "-i", str(video_path),
-            "-q:a", "0", "-map", "a", str(extracted_mp3)
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-
-        # Step 2: Run transkun
-        subprocess.run([
-            TRANSTOOL, str(extracted_mp3), str(transkun_midi)
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-
-        # Step 3: Align
-        subprocess.run([
-            "python", CORRECTION,
-            "--gt", str(gt_midi_path),
-            "--transkun", str(transkun_midi),
-            "--output", str(aligned_midi)
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-
-        # Step 4: Synthesize audio
-        subprocess.run([
-            "python", TOAUDIO,
-            "--midi", str(aligned_midi),
-            "--output", str(audio_output_wav)
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-
-        # Step 5: Replace audio
-        subprocess.run([
-            "ffmpeg", "-y",
-            "-i", str(video_path),
-            "-i", str(audio_output_wav),
-            "-c:v", "copy", "-map", "0:v:0", "-map", "1:a:0",
-            "-shortest", str(new_mp4_path)
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-
-        # Step 6: Generate overlap visualization
-        subprocess.run([
-            "python", OVERLAP,
-            "--transkun", str(transkun_midi),
-            "--aligned", str(aligned_midi),
-            "--output", str(overlap_png),
-            "--start", "70", "--end", "80",
-            "--display_mode", "time",
-            "--fps", str(FPS)
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-
-    except subprocess.CalledProcessError:
-        print(f"\nError processing case{idx}: {subdir.name}")
-        continue
-
-print("\nAll cases processed.")
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """This process' peak RSS since the last reset_peak_rss (VmHWM), in MB."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    raise OSError("no VmHWM in /proc/self/status")
+
+def stage_record(c, k, cached, wall=0.0, usage=None):
+    """
+    One JSON-lines entry: case, stage, wall/CPU seconds, peak RSS and output sizes.
+    `rss_scope` is "stage" when max_rss_mb covers this stage run only, "worker" when it is
+    the pool worker's lifetime peak (peak RSS could not be reset).
+    """
+    name, _, outputs = stage_files(c, k)
+    record = {"case": c["name"], "stage": name, "cached": cached, "wall_s": round(wall, 4),
+              "cpu_s": None, "max_rss_mb": None, "rss_scope": None if cached else "stage",
+              "output_bytes": {Path(p).name: Path(p).stat().st_size for p in outputs if Path(p).exists()}}
+    record.update(usage or {})
+    return record
+
+def run_stage(k, c, force=False):
+    """
+    Run stage k for case c unless the case manifest already holds its key (inputs
+    re-hashed only if touched). Records the outputs afterwards. Returns the stage's
+    stage_record. Thread stages report their subprocess' rusage; process stages measure
+    their worker (self + children), with its peak RSS reset before the stage where the OS
+    allows it.
+    """
+    name, inputs, outputs = stage_files(c, k)
+    manifest = stage_cache.Manifest(c["case_dir"])
+    key = manifest.stage_key(name, inputs, stage_params(c, name))
+    cached = not force and manifest.is_current(name, key, outputs)
+    wall, usage = 0.0, None
+    if not cached:
+        in_worker = STAGES[k][2] == "process"
+        cpu0, _, child_rss0 = process_usage()
+        reset = in_worker and reset_peak_rss()
+        t0 = time.perf_counter()
+        usage = STAGES[k][1](c) or {}
+        wall = time.perf_counter() - t0
+        if in_worker:
+            cpu1, own_rss, child_rss = process_usage()
+            if reset:
+                own_rss = peak_rss_mb()
+            # the children's peak is a lifetime figure too: it only belongs to this stage if it grew
+            rss = max(own_rss, child_rss if child_rss > child_rss0 else 0.0)
+            usage.update({"cpu_s": cpu1 - cpu0, "max_rss_mb": rss, "rss_scope": "stage" if reset else "worker"})
+        manifest.record(name, key, outputs)
+    manifest.save()
+    return stage_record(c, k, cached, wall, usage)
+
+def quiet_worker():
+    """Pool initializer: keep in-process stages as silent as the old subprocess calls."""
+    logging.getLogger("correction").setLevel(logging.WARNING)
+    sys.stdout = open(os.devnull, "w")
+
+
+# ========== scheduler ==========
+def run_pipeline(cases, stage_jobs, force=False, stats_log=None):
+    """
+    Push every case through STAGES in order. Each stage has its own pool, so a case
+    moves on as soon as its previous stage finishes and different cases occupy
+    different stages at the same time. Stages whose cache key is unchanged are skipped
+    unless `force`. Every stage outcome is appended to `stats_log` (JSON lines) as it
+    arrives. Returns (failures as (case, stage, error), stage records).
+    """
+    pools = {}
+    for name, _, kind, _, _ in STAGES:
+        executor = ThreadPoolExecutor if kind == "thread" else ProcessPoolExecutor
+        # spawn, not fork: forking while thread pools run subprocesses can deadlock the child
+        kwargs = {} if kind == "thread" else {"initializer": quiet_worker,
+                                              "mp_context": multiprocessing.get_context("spawn")}
+        pools[name] = executor(max_workers=stage_jobs[name], **kwargs)
+
+    running, failures, records = {}, [], []
+    bar = tqdm(total=len(cases), desc="Processing Cases")
+    run_id = time.strftime("%Y-%m-%dT%H:%M:%S")
+    log_file = None
+    if stats_log is not None:
+        Path(stats_log).parent.mkdir(parents=True, exist_ok=True)
+        log_file = open(stats_log, "a")
+
+    def emit(record):
+        record["run"] = run_id
+        records.append(record)
+        if log_file is not None:
+            log_file.write(json.dumps(record, default=str) + "\n")
+            log_file.flush()
+
+    def submit(c, k):
+        # skip stages that are already up to date, then hand the case to the next pool
+        while not force and k < len(STAGES) and is_cached(c, k):
+            emit(stage_record(c, k, cached=True))
+            k += 1
+        if k == len(STAGES):
+            bar.update(1)
+            return
+        running[pools[STAGES[k][0]].submit(run_stage, k, c, force)] = (c, k)
+
+    try:
+        for c in cases:
+            submit(c, 0)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                c, k = running.pop(fut)
+                err = fut.exception()
+                if err is not None:
+                    failures.append((c, STAGES[k][0], err))
+                    tqdm.write(f"Error processing {c['name']} at {STAGES[k][0]}: {err}")
+                    emit({"case": c["name"], "stage": STAGES[k][0], "cached": False, "error": str(err)})
+                    bar.update(1)
+                else:
+                    emit(fut.result())
+                    submit(c, k + 1)
+    finally:
+        bar.close()
+        if log_file is not None:
+            log_file.close()
+        for pool in pools.values():
+            pool.shutdown(cancel_futures=True)
+    return failures, records
+
+def summary_table(records):
+    """
+    Per-stage totals of the run: runs, cached, failed, wall/CPU seconds, peak RSS, output size.
+    Peaks that are worker lifetime figures rather than per-stage ones are marked with '*'.
+    """
+    header = f"{'stage':<10}{'run':>5}{'cached':>8}{'failed':>8}{'wall s':>10}{'mean s':>9}{'cpu s':>10}{'peak MB':>9}{'out MB':>9}"
+    lines = [header, "-" * len(header)]
+    for name, *_ in STAGES:
+        rows = [r for r in records if r["stage"] == name]
+        ran = [r for r in rows if not r["cached"] and "error" not in r]
+        wall = sum(r["wall_s"] for r in ran)
+        cpu = sum(r["cpu_s"] or 0.0 for r in ran)
+        rss = max((r["max_rss_mb"] or 0.0 for r in ran), default=0.0)
+        mark = "*" if any(r.get("rss_scope") == "worker" for r in ran) else " "
+        out = sum(sum(r.get("output_bytes", {}).values()) for r in rows if "error" not in r) / 2 ** 20
+        lines.append(f"{name:<10}{len(ran):>5}{sum(r['cached'] for r in rows):>8}{sum('error' in r for r in rows):>8}"
+                     f"{wall:>10.1f}{wall / max(len(ran), 1):>9.2f}{cpu:>10.1f}{rss:>8.0f}{mark}{out:>9.1f}")
+    if any(r.get("rss_scope") == "worker" for r in records):
+        lines.append("* worker peak RSS (could not be reset per stage)")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run extract -> transkun -> align -> render+mux -> overlap for every case, pipelined across per-stage worker pools.")
+    parser.add_argument("--base-dir", type=Path, default=BASE_DIR, help="Folder that receives the caseN output folders")
+    parser.add_argument("--source-dir", type=Path, default=None, help="Folder with one subfolder per recording (default: BASE_DIR/2025-07-18)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Cores to spread the stage pools over (default: all)")
+    parser.add_argument("--stage-jobs", action="append", default=[], metavar="STAGE=N", help="Override one stage's pool size, e.g. transkun=2 (repeatable)")
+    parser.add_argument("--keep-wav", action="store_true", help="Also write aligned_output.wav (debug); audio is otherwise piped straight into ffmpeg")
+    parser.add_argument("--audio", choices=sorted(AUDIO_FILES), default=AUDIO_FORMAT, help=f"Audio handed to transkun: mono PCM WAV, PCM in a temporary file the transkun step removes, or the old mp3 (default: {AUDIO_FORMAT})")
+    parser.add_argument("--audio-range", type=float, nargs=2, default=AUDIO_RANGE, metavar=("START", "END"), help="Only transcribe this span of the video (s); the MIDI keeps video time")
+    parser.add_argument("--force", action="store_true", help="Rerun every stage even if its cache key in the case manifest matches")
+    parser.add_argument("--stats-log", type=Path, default=None, help="JSON-lines file receiving per case/stage timing and resource records (default: BASE_DIR/pipeline_stats.jsonl)")
+    args = parser.parse_args()
+
+    source_dir = args.source_dir or args.base_dir / SOURCE_DIR.name
+    stage_jobs = default_stage_jobs(args.jobs)
+    for item in args.stage_jobs:
+        name, _, n = item.partition("=")
+        if name not in stage_jobs or not n.isdigit() or int(n) < 1:
+            parser.error(f"--stage-jobs expects STAGE=N with STAGE in {sorted(stage_jobs)}, got {item!r}")
+        stage_jobs[name] = int(n)
+
+    # Collect cases
+    subfolders = sorted([d for d in source_dir.iterdir() if d.is_dir()])
+    print(f"Found {len(subfolders)} cases.")
+    print("Stage workers: " + ", ".join(f"{k}={v}" for k, v in stage_jobs.items()))
+    if args.audio_range and not 0 <= args.audio_range[0] < args.audio_range[1]:
+        parser.error(f"--audio-range needs 0 <= START < END, got {args.audio_range}")
+    cases = [case_paths(idx, subdir, args.base_dir, args.keep_wav, args.audio, args.audio_range) for idx, subdir in enumerate(subfolders, start=1)]
+
+    stats_log = args.stats_log or args.base_dir / "pipeline_stats.jsonl"
+    failures, records = run_pipeline(cases, stage_jobs, force=args.force, stats_log=stats_log)
+    cached = sum(r["cached"] for r in records)
+    print(f"\nAll cases processed ({len(failures)} failed, {cached} stages reused from cache).")
+    print(summary_table(records))
+    print(f"Stage records appended to: {stats_log}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# One manifest per case directory:
+# {
+#   "files":  {abs_path: {"size", "mtime_ns", "sha256"}},        # digest memo, reused while size/mtime match
+#   "stages": {stage: {"key", "outputs": {abs_path: sha256}}},  # key = hash(stage, params, input digests)
+# }
+MANIFEST_NAME = "manifest.json"
+CHUNK = 1 << 20
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Stage-level artifact cache for one case directory."""
+
+    def __init__(self, case_dir):
+        self.path = Path(case_dir) / MANIFEST_NAME
+        try:
+            data = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            data = {}
+        self.files = data.get("files", {})
+        self.stages = data.get("stages", {})
+
+    def digest(self, path, compute=True):
+        """
+        Content hash of `path`. Re-hashes only when size or mtime changed since the
+        last time; with compute=False returns None instead of hashing.
+        """
+        path = Path(path)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        entry = self.files.get(str(path))
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["sha256"]
+        if not compute:
+            return None
+        sha = sha256_file(path)
+        self.files[str(path)] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha}
+        return sha
+
+    def stage_key(self, stage, inputs, params, compute=True):
+        """Key of a stage run: its name, parameters and input contents (not input paths)."""
+        digests = [self.digest(p, compute) for p in inputs]
+        if None in digests:
+            return None
+        blob = json.dumps({"stage": stage, "params": params, "inputs": digests}, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def is_current(self, stage, key, outputs, compute=True):
+        """The stage last ran with `key` and all its recorded outputs are still intact."""
+        entry = self.stages.get(stage)
+        if key is None or not entry or entry["key"] != key:
+            return False
+        recorded = entry["outputs"]
+        return all(str(p) in recorded and self.digest(p, compute) == recorded[str(p)] for p in outputs)
+
+    def record(self, stage, key, outputs):
+        self.stages[stage] = {"key": key, "outputs": {str(p): self.digest(p) for p in outputs}}
+
+    def save(self):
+        # write-then-rename so an interrupted run never leaves a half-written manifest
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps({"files": self.files, "stages": self.stages}, indent=1, sort_keys=True))
+        os.replace(tmp, self.path)
@@ -1,24 +1,228 @@
 import argparse
+import subprocess
+import tempfile
+import wave
 import pretty_midi
 from scipy.io.wavfile import write
 import numpy as np
 from pathlib import Path
 
-def midi_to_audio(midi_path, wav_path):
+try:
+    import fluidsynth
+except ImportError:
+    fluidsynth = None
+
+SAMPLE_RATE = 44100
+BLOCK_SAMPLES = 1 << 16   # samples per streamed block (~1.5 s at 44.1 kHz)
+TAIL_SECONDS = 1.0        # silence rendered after the last event, as pretty_midi does
+DEFAULT_SF2 = Path(pretty_midi.__file__).parent / "TimGM6mb.sf2"   # soundfont bundled with pretty_midi
+
+
+# ========== streaming synthesis ==========
+class InstrumentVoice:
+    """
+    One fluidsynth instance playing one instrument's events, rendered on demand.
+    Mirrors pretty_midi.Instrument.fluidsynth (channel/bank choice, event order),
+    but hands out samples block by block instead of allocating the whole piece.
+    """
+    def __init__(self, inst, fs, sf2_path):
+        self.synth = fluidsynth.Synth(samplerate=fs)
+        sfid = self.synth.sfload(str(sf2_path))
+        if inst.is_drum:
+            self.channel = 9
+            if self.synth.program_select(self.channel, sfid, 128, inst.program) == -1:
+                self.synth.program_select(self.channel, sfid, 128, 0)
+        else:
+            self.channel = 0
+            self.synth.program_select(self.channel, sfid, 0, inst.program)
+
+        events = [(n.start, 1, "note on", n.pitch, n.velocity) for n in inst.notes]
+        events += [(n.end, 0, "note off", n.pitch, None) for n in inst.notes]
+        events += [(b.time, 1, "pitch bend", b.pitch, None) for b in inst.pitch_bends]
+        events += [(cc.time, 1, "control change", cc.number, cc.value) for cc in inst.control_changes]
+        # by time, note-offs first (same order as pretty_midi)
+        events.sort(key=lambda e: (e[0], e[1]))
+        self.end_time = events[-1][0]
+        self.events = [(int(fs * t), kind, a, b) for t, _, kind, a, b in events]
+        self.next_event = 0
+        self.pos = 0
+
+    def _apply(self, kind, a, b):
+        if kind == "note on":
+            self.synth.noteon(self.channel, a, b)
+        elif kind == "note off":
+            self.synth.noteoff(self.channel, a)
+        elif kind == "pitch bend":
+            self.synth.pitch_bend(self.channel, a)
+        else:
+            self.synth.cc(self.channel, a, b)
+
+    def read(self, n):
+        """Next n mono samples (int16 scale, float64)."""
+        out = np.empty(n)
+        filled = 0
+        while filled < n:
+            if self.next_event < len(self.events) and self.events[self.next_event][0] <= self.pos:
+                self._apply(*self.events[self.next_event][1:])
+                self.next_event += 1
+                continue
+            until = self.events[self.next_event][0] if self.next_event < len(self.events) else self.pos + n
+            k = min(n - filled, until - self.pos)
+            out[filled:filled + k] = self.synth.get_samples(k)[::2]
+            filled += k
+            self.pos += k
+        return out
+
+    def close(self):
+        self.synth.delete()
+
+def render_blocks(midi, fs=SAMPLE_RATE, block=BLOCK_SAMPLES, sf2_path=DEFAULT_SF2):
+    """
+    Yield the mono mix of `midi` as float64 blocks of at most `block` samples
+    (int16 scale, not normalized). Each instrument has its own synth, advanced in
+    lockstep, so memory does not depend on the length of the piece.
+    """
+    if fluidsynth is None:
+        raise ImportError("Streaming rendering needs pyfluidsynth (pip install pyfluidsynth).")
+    voices = [InstrumentVoice(inst, fs, sf2_path) for inst in midi.instruments if inst.notes]
+    if not voices:
+        return
+    total = int(np.ceil(fs * (max(v.end_time for v in voices) + TAIL_SECONDS)))
+    try:
+        for start in range(0, total, block):
+            n = min(block, total - start)
+            mix = voices[0].read(n)
+            for v in voices[1:]:
+                mix += v.read(n)
+            yield mix
+    finally:
+        for v in voices:
+            v.close()
+
+def pcm_blocks(midi, fs=SAMPLE_RATE, normalize="peak", block=BLOCK_SAMPLES):
+    """
+    Yield int16 PCM blocks of the rendered piece.
+      normalize="peak":  same scaling as the in-memory path (global peak -> 32767). The raw
+                         mix is spilled to a float32 temp file (exact: the synth output is
+                         integer-valued) while the peak is tracked, then rescaled block by block.
+      normalize="limit": single pass, fixed unity gain with hard clipping at full scale.
+    """
+    if normalize == "limit":
+        for mix in render_blocks(midi, fs, block):
+            yield np.clip(mix, -32767, 32767).astype(np.int16)
+        return
+    if normalize != "peak":
+        raise ValueError(f"normalize must be 'peak' or 'limit', got {normalize!r}")
+
+    with tempfile.TemporaryFile() as spill:
+        peak, total = 0.0, 0
+        for mix in render_blocks(midi, fs, block):
+            peak = max(peak, float(np.max(np.abs(mix))))
+            spill.write(mix.astype(np.float32).tobytes())
+            total += len(mix)
+        spill.seek(0)
+        for start in range(0, total, block):
+            mix = np.frombuffer(spill.read(4 * min(block, total - start)), dtype=np.float32).astype(np.float64)
+            yield np.int16(mix / peak * 32767) if peak > 0 else np.zeros(len(mix), dtype=np.int16)
+
+def write_wav_stream(blocks, wav_path, fs=SAMPLE_RATE):
+    """Write mono int16 blocks to `wav_path` as they arrive."""
+    for _ in tee_wav(blocks, wav_path, fs):
+        pass
+
+
+def tee_wav(blocks, wav_path, fs=SAMPLE_RATE):
+    """Pass blocks through unchanged while also writing them to `wav_path`."""
+    wav_path = Path(wav_path)
+    wav_path.parent.mkdir(parents=True, exist_ok=True)
+    with wave.open(str(wav_path), "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(fs)
+        for b in blocks:
+            wf.writeframes(b.astype("<i2").tobytes())
+            yield b
+
+def mux_stream(blocks, video_path, mp4_path, fs=SAMPLE_RATE, quiet=True, drain=False):
+    """
+    Replace the audio track of `video_path` with mono int16 PCM blocks piped into
+    ffmpeg's stdin, writing `mp4_path` (video stream copied, like the WAV-based mux).
+    `drain` keeps consuming blocks after ffmpeg stops reading (e.g. to finish a tee'd WAV).
+    """
+    mp4_path = Path(mp4_path)
+    mp4_path.parent.mkdir(parents=True, exist_ok=True)
+    cmd = [
+        "ffmpeg", "-y",
+        "-i", str(video_path),
+        "-f", "s16le", "-ar", str(fs), "-ac", "1", "-i", "pipe:0",
+        "-c:v", "copy", "-map", "0:v:0", "-map", "1:a:0",
+        "-shortest", str(mp4_path)
+    ]
+    out = subprocess.DEVNULL if quiet else None
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out, stderr=out)
+    try:
+        for b in blocks:
+            proc.stdin.write(b.astype("<i2").tobytes())
+    except BrokenPipeError:
+        # -shortest: ffmpeg stops reading once the video ends
+        if drain:
+            for _ in blocks:
+                pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+# ========== entry points ==========
+def midi_to_audio(midi_path, wav_path, streaming=True, normalize="peak"):
     midi = pretty_midi.PrettyMIDI(str(midi_path))
-    audio = midi.fluidsynth(fs=44100) 
+    if streaming:
+        write_wav_stream(pcm_blocks(midi, SAMPLE_RATE, normalize), wav_path, SAMPLE_RATE)
+        print(f"Audio saved to: {wav_path} (streamed with fluidsynth, {normalize} normalization)")
+        return
+
+    audio = midi.fluidsynth(fs=SAMPLE_RATE)
     audio_int16 = np.int16(audio / np.max(np.abs(audio)) * 32767)
-    
+
     wav_path = Path(wav_path)
     wav_path.parent.mkdir(parents=True, exist_ok=True)
-    write(wav_path, 44100, audio_int16)
+    write(wav_path, SAMPLE_RATE, audio_int16)
     print(f"Audio saved to: {wav_path} (rendered with fluidsynth)")
 
+def midi_to_video(midi_path, video_path, mp4_path, wav_path=None, normalize="peak"):
+    """
+    Render `midi_path` and stream it straight into ffmpeg as the new audio track of
+    `video_path`; no intermediate WAV unless `wav_path` is given (debug copy).
+    """
+    midi = pretty_midi.PrettyMIDI(str(midi_path))
+    blocks = pcm_blocks(midi, SAMPLE_RATE, normalize)
+    if wav_path is not None:
+        blocks = tee_wav(blocks, wav_path, SAMPLE_RATE)
+    mux_stream(blocks, video_path, mp4_path, SAMPLE_RATE, drain=wav_path is not None)
+    print(f"Video saved to: {mp4_path} (audio piped from fluidsynth, {normalize} normalization)")
+
 # === CLI entry ===
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Render MIDI to audio (.wav) using fluidsynth")
+    parser = argparse.ArgumentParser(description="Render MIDI to audio (.wav) using fluidsynth, or pipe it into a video's audio track")
     parser.add_argument("--midi", type=str, required=True, help="Input MIDI file path")
-    parser.add_argument("--output", type=str, required=True, help="Output WAV file path")
+    parser.add_argument("--output", type=str, default=None, help="Output WAV file path (optional debug copy with --video)")
+    parser.add_argument("--video", type=str, default=None, help="Video whose audio track is replaced (render-and-mux mode)")
+    parser.add_argument("--video-output", type=str, default=None, help="Output MP4 path for --video")
+    parser.add_argument("--in-memory", action="store_true", help="Render the whole piece at once with pretty_midi (high memory on long pieces)")
+    parser.add_argument("--normalize", choices=["peak", "limit"], default="peak",
+                        help="Streaming only: exact global peak via a temp spill (default), or single-pass hard limit")
     args = parser.parse_args()
 
-    midi_to_audio(args.midi, args.output)
+    if args.video:
+        if not args.video_output or args.in_memory:
+            parser.error("--video needs --video-output and the streaming renderer")
+        midi_to_video(args.midi, args.video, args.video_output, wav_path=args.output, normalize=args.normalize)
+    elif args.output:
+        midi_to_audio(args.midi, args.output, streaming=not args.in_memory, normalize=args.normalize)
+    else:
+        parser.error("give --output, or --video with --video-output")
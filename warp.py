@@ -0,0 +1,186 @@
+import argparse
+import json
+from pathlib import Path
+import numpy as np
+import pretty_midi
+
+from notetable import NoteTable
+
+WARP_VERSION = 1
+
+
+class TimeWarp:
+    """
+    Piecewise-linear GT -> Transkun time map found by correction.align, reusable without
+    rerunning the anchor search:
+      mappings : (n, 4) float64 rows (seg_start, seg_end, a, b), t' = a * t + b
+      epsilon  : a time t belongs to the first segment with seg_start <= t < seg_end + epsilon
+      anchors  : (m, 3) float64 rows (gt_time, trans_time, ratio), informational
+    Times outside every segment follow the nearest segment before them (the first one for
+    times before it), so the warp stays monotone past the last GT onset; with
+    `extrapolate=False` they are left unchanged instead.
+    """
+
+    def __init__(self, mappings, epsilon, anchors=None):
+        self.mappings = np.asarray(mappings, dtype=np.float64).reshape(-1, 4)
+        self.epsilon = float(epsilon)
+        self.anchors = np.zeros((0, 3)) if anchors is None else np.asarray(anchors, dtype=np.float64).reshape(-1, 3)
+
+    @classmethod
+    def from_result(cls, result):
+        """From a correction.AlignmentResult."""
+        anchors = [(gt_time, trans_time, ratio) for gt_time, _, trans_time, _, ratio, _ in result.anchors]
+        return cls(result.mappings, result.epsilon, anchors)
+
+    # ---------- sidecar I/O ----------
+    def save(self, path):
+        """Write to `path`: .npz for the binary form, anything else as JSON."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == ".npz":
+            np.savez(path, version=WARP_VERSION, epsilon=self.epsilon,
+                     mappings=self.mappings, anchors=self.anchors)
+            return
+        # json writes floats with repr, so values round-trip exactly
+        path.write_text(json.dumps({
+            "version": WARP_VERSION,
+            "epsilon": self.epsilon,
+            "mappings": self.mappings.tolist(),
+            "anchors": self.anchors.tolist(),
+        }, indent=1))
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        if path.suffix == ".npz":
+            with np.load(path) as data:
+                version, epsilon = int(data["version"]), float(data["epsilon"])
+                mappings, anchors = data["mappings"], data["anchors"]
+        else:
+            data = json.loads(path.read_text())
+            version, epsilon = data.get("version"), data["epsilon"]
+            mappings, anchors = data["mappings"], data.get("anchors")
+        if version != WARP_VERSION:
+            raise ValueError(f"{path}: unsupported warp version {version!r}")
+        return cls(mappings, epsilon, anchors)
+
+    # ---------- application ----------
+    def segment_of(self, times):
+        """Segment index of every time (-1 outside all segments)."""
+        times = np.asarray(times, dtype=np.float64)
+        seg_start, seg_end = self.mappings[:, 0], self.mappings[:, 1]
+        # segments are sorted: the first whose widened end lies beyond t, if it has started
+        k = np.searchsorted(seg_end + self.epsilon, times, side="right")
+        inside = k < len(seg_start)
+        inside[inside] = seg_start[k[inside]] <= times[inside]
+        return np.where(inside, k, -1)
+
+    def extend_segments(self, times, segments):
+        """
+        `segments` (from segment_of) with every -1 replaced by the last segment starting at or
+        before its time, or the first segment for times before all of them.
+        """
+        outside = segments < 0
+        if not outside.any():
+            return segments
+        k = segments.copy()
+        before = np.searchsorted(self.mappings[:, 0], times[outside], side="right") - 1
+        k[outside] = np.maximum(before, 0)
+        return k
+
+    def apply_times(self, times, segments=None, extrapolate=True):
+        """
+        Warp an array of times; `segments` (from segment_of) picks the mapping per time.
+        Times outside the segments extrapolate the nearest segment's mapping, or stay
+        unchanged without `extrapolate`:
+
+        >>> w = TimeWarp([(0, 120, 1.02, 1.5), (120, 300, 1.03, 0.3)], 0.01)
+        >>> np.round(w.apply_times([-1, 299, 300.005, 300.5, 302]), 3).tolist()
+        [0.48, 308.27, 309.305, 309.815, 311.36]
+        >>> np.round(w.apply_times([-1, 299, 300.005, 300.5, 302], extrapolate=False), 3).tolist()
+        [-1.0, 308.27, 309.305, 300.5, 302.0]
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if not len(self.mappings):
+            return times.copy()
+        k = self.segment_of(times) if segments is None else np.asarray(segments)
+        if not extrapolate:
+            inside = k >= 0
+            out = times.copy()
+            out[inside] = self.mappings[k[inside], 2] * times[inside] + self.mappings[k[inside], 3]
+            return out
+        k = self.extend_segments(times, k)
+        return self.mappings[k, 2] * times + self.mappings[k, 3]
+
+    def apply_notes(self, notes, extrapolate=True):
+        """
+        Warp a NoteTable (new table) or (start, end, pitch) rows (new (N, 3) array).
+        Each note's end follows the mapping chosen by its onset.
+        """
+        if isinstance(notes, NoteTable):
+            k = self.segment_of(notes.start)
+            return NoteTable(self.apply_times(notes.start, k, extrapolate), self.apply_times(notes.end, k, extrapolate),
+                             notes.pitch, notes.velocity, notes.instrument, notes.drum, notes.order)
+        arr = np.array(notes, dtype=np.float64).reshape(-1, 3)
+        k = self.segment_of(arr[:, 0])
+        arr[:, 0], arr[:, 1] = self.apply_times(arr[:, 0], k, extrapolate), self.apply_times(arr[:, 1], k, extrapolate)
+        return arr
+
+    def apply_midi(self, midi, control_changes=True, extrapolate=True):
+        """
+        Warp a PrettyMIDI in place: notes (end follows the onset's segment) and, with
+        `control_changes`, pedal/CC events and pitch bends. Returns `midi`.
+        """
+        notes = [note for inst in midi.instruments for note in inst.notes]
+        if notes and len(self.mappings):
+            starts = np.array([note.start for note in notes], dtype=np.float64)
+            ends = np.array([note.end for note in notes], dtype=np.float64)
+            k = self.segment_of(starts)
+            starts, ends = self.apply_times(starts, k, extrapolate), self.apply_times(ends, k, extrapolate)
+            for note, s, e in zip(notes, starts.tolist(), ends.tolist()):
+                note.start = s
+                note.end = e
+        if control_changes:
+            events = [ev for inst in midi.instruments for ev in inst.control_changes + inst.pitch_bends]
+            if events and len(self.mappings):
+                times = self.apply_times([ev.time for ev in events], extrapolate=extrapolate).tolist()
+                for ev, t in zip(events, times):
+                    ev.time = t
+        return midi
+
+
+def load_warp(source):
+    """TimeWarp from a sidecar path, an AlignmentResult or a TimeWarp."""
+    if isinstance(source, TimeWarp):
+        return source
+    if isinstance(source, (str, Path)):
+        return TimeWarp.load(source)
+    return TimeWarp.from_result(source)
+
+def apply_warp_file(warp_path, midi_path, output_path, control_changes=True):
+    """Warp another MIDI of the same performance with a saved sidecar and write it."""
+    midi = pretty_midi.PrettyMIDI(str(midi_path))
+    TimeWarp.load(warp_path).apply_midi(midi, control_changes=control_changes)
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    midi.write(str(output_path))
+    print(f"Warped MIDI saved to: {output_path}")
+
+# === CLI entry ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply a saved GT -> Transkun time warp (from correction.py --warp) to a MIDI file or a list of timestamps.")
+    parser.add_argument("--warp", type=str, required=True, help="Warp sidecar (.json or .npz)")
+    parser.add_argument("--midi", type=str, default=None, help="MIDI file to warp")
+    parser.add_argument("--times", type=str, default=None, help="Text file with one timestamp (seconds) per line")
+    parser.add_argument("--output", type=str, required=True, help="Output MIDI (with --midi) or text file (with --times)")
+    parser.add_argument("--notes-only", action="store_true", help="Leave control changes and pitch bends untouched")
+    args = parser.parse_args()
+
+    if (args.midi is None) == (args.times is None):
+        parser.error("give exactly one of --midi or --times")
+    if args.midi:
+        apply_warp_file(args.warp, args.midi, args.output, control_changes=not args.notes_only)
+    else:
+        times = np.loadtxt(args.times, dtype=np.float64, ndmin=1)
+        np.savetxt(args.output, TimeWarp.load(args.warp).apply_times(times), fmt="%.6f")
+        print(f"Warped {len(times)} timestamps saved to: {args.output}")